@@ -1,121 +1,323 @@
 from typing import TypedDict, List, Dict, Any, Optional
 from langgraph.graph import StateGraph, END
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from langgraph.config import get_stream_writer
 from tooling.agent_capabilities import *
 from tooling.vector_search import *
-import streamlit as st
+from tooling.score_matrix import ScoreMatrix
+from tooling.instrumentation import traced, trace_run
+from tooling.context_packing import pack_context, pack_contexts, interleave
+from tooling.cache import stream_with_cache
+from langgraph.checkpoint.sqlite import SqliteSaver
+import asyncio
+import hashlib
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+EVAL_CONCURRENCY = int(os.getenv("EVAL_CONCURRENCY", "8"))
+EVAL_WRITE_EVERY = int(os.getenv("EVAL_WRITE_EVERY", "25"))  # graded students buffered per comprehension write
+WEAK_THRESHOLD = 70
+LESSON_PLAN_K = 6
+HOMEWORK_K = 3
+# one grader call per student covering every concept (falls back per concept on bad output)
+BATCH_SCORING = os.getenv("BATCH_SCORING", "1") != "0"
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))  # parallel per-student/per-concept generations
+# prompt context budgets (tokens); retrieved chunks are merged, deduplicated and packed best-first
+EVAL_CONTEXT_TOKENS = int(os.getenv("EVAL_CONTEXT_TOKENS", "600"))  # per (student, concept)
+LESSON_CONTEXT_TOKENS = int(os.getenv("LESSON_CONTEXT_TOKENS", "800"))  # per lesson plan
+HOMEWORK_CONTEXT_TOKENS = int(os.getenv("HOMEWORK_CONTEXT_TOKENS", "800"))  # per student, all weak concepts
+PIPELINE_CHECKPOINT_PATH = os.getenv("PIPELINE_CHECKPOINT_PATH", ".cache/pipeline_checkpoints.sqlite")
 
 class PipelineState(TypedDict, total=False):
     concepts: List[str]
     students: List[str]
     homework_vector_table: str
     lesson_vector_table: str
-    scores: Dict[str, Dict[str, float]]
+    scores: ScoreMatrix  # dict-compatible: scores[student][concept]
     pain_points: Dict[str, Dict[str, List[str]]]
     reports: Dict[str, str]
     groups: Dict[int, List[str]]
     lesson_plans: Dict[str, str]
     homework: Dict[str, str]
+    lesson_context: Dict[str, List[Any]]
+    bypass_llm_cache: bool
+    incremental: bool
+    run_id: str  # stamped on every row this run writes to TiDB
+
+def _score_matrix(state: PipelineState) -> ScoreMatrix:
+    # checkpoints written before ScoreMatrix hold plain nested dicts
+    return ScoreMatrix.from_dict(state["scores"], state["concepts"])
+
+def _progress(config: Optional[RunnableConfig], node: str, message: str, **fields):
+    """
+    Progress goes to config["configurable"]["progress"](event) when the caller supplied one
+    (the Streamlit UI, the batch runner); nodes never talk to a UI directly.
+    """
+    cb = ((config or {}).get("configurable") or {}).get("progress")
+    if cb is not None:
+        cb({"node": node, "message": message, **fields})
+
+def new_run_id() -> str:
+    # sortable by start time; unique across processes and machines
+    return time.strftime("%Y%m%dT%H%M%S", time.gmtime()) + "-" + secrets.token_hex(4)
+
+def _llm(state: PipelineState):
+    return get_llm(use_cache=LLM_CACHE_ENABLED and not state.get("bypass_llm_cache", False))
+
+def _generate_all(llm, prompts: List[list]) -> List[str]:
+    # independent prompts go out concurrently (bounded), results come back in input order
+    if not prompts:
+        return []
+    return [m.content for m in llm.batch(prompts, config={"max_concurrency": LLM_CONCURRENCY})]
+
+def _streaming(config: Optional[RunnableConfig]) -> bool:
+    return bool(((config or {}).get("configurable") or {}).get("stream_tokens"))
+
+def _generate(llm, prompts: List[list], keys: List[str], node: str, config: Optional[RunnableConfig],
+              persist) -> tuple:
+    """
+    One text per key -> (texts, texts not yet persisted).
+    In streaming mode (run_pipeline(on_token=...)) every prompt is streamed concurrently: tokens go to the
+    graph's custom stream as {"node", "key", "delta"}, and each finished text is persist()ed and announced
+    as {"node", "key", "text", "done": True} without waiting for the others. Cached texts arrive as one delta.
+    """
+    if not _streaming(config) or not prompts:
+        texts = dict(zip(keys, _generate_all(llm, prompts)))
+        return texts, texts
+    writer = get_stream_writer()
+    def one(i: int) -> str:
+        parts = []
+        for delta in stream_with_cache(llm, prompts[i]):
+            parts.append(delta)
+            writer({"node": node, "key": keys[i], "delta": delta})
+        out = "".join(parts)
+        persist({keys[i]: out})
+        writer({"node": node, "key": keys[i], "text": out, "done": True})
+        return out
+    # context-copying pool: the workers keep the node's stream writer and trace
+    with ContextThreadPoolExecutor(max_workers=max(1, min(LLM_CONCURRENCY, len(prompts)))) as pool:
+        return dict(zip(keys, pool.map(one, range(len(prompts))))), {}
 
+# Nodes return only the keys they produce: after evaluate, several nodes run in the same step
+# and LangGraph merges their updates.
+@traced("node.ingest")
 def node_ingest(state: PipelineState) -> PipelineState:
     # ingestion is driven by UI for now(files are uploaded & added to vector store).
-    return state
+    return {"run_id": state.get("run_id") or new_run_id()}
 
-def node_evaluate(state: PipelineState) -> PipelineState:
-    llm = get_llm()
+def _run_async(coro):
+    # asyncio.run refuses to nest; if a loop is already running in this thread, run on a helper thread.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    out: Dict[str, Any] = {}
+    def runner():
+        try:
+            out["result"] = asyncio.run(coro)
+        except BaseException as e:
+            out["error"] = e
+    t = threading.Thread(target=runner)
+    t.start(); t.join()
+    if "error" in out:
+        raise out["error"]
+    return out["result"]
+
+def _snippets(docs, max_tokens: int = EVAL_CONTEXT_TOKENS) -> List[str]:
+    return pack_context(docs, max_tokens)
+
+def _evidence_hash(docs) -> str:
+    # fingerprint of the exact chunks (in rank order) a score is based on
+    h = hashlib.sha256()
+    for d in docs:
+        h.update(((d.metadata or {}).get("chunk_hash") or d.page_content).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+async def _evaluate_pairs(llm, engine, contexts: Dict[tuple, List[Any]], students: List[str], concepts: List[str],
+                          concurrency: int, reuse: Optional[Dict[tuple, Dict[str, Any]]] = None, batch: bool = BATCH_SCORING,
+                          config: Optional[RunnableConfig] = None, run_id: Optional[str] = None):
+    """
+    Grades every pair not present in `reuse`; finished students are buffered and written every
+    EVAL_WRITE_EVERY students (and on the way out, even on failure), so an interrupted run keeps them
+    (and an incremental re-run picks them up).
+    Reused scores are written again under this run_id, so every run has a full row set in the history.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency))
+    reuse = reuse or {}
+    buffer: Dict[str, Dict[str, Dict[str, Any]]] = {"scores": {}, "pain_points": {}, "hashes": {}}
+    async def flush():
+        if not buffer["scores"]:
+            return
+        out = dict(buffer)
+        buffer.update(scores={}, pain_points={}, hashes={})
+        await asyncio.to_thread(write_comprehension_batch, engine, out["scores"], out["pain_points"], out["hashes"],
+                                run_id=run_id)
+    async def one(student: str, concept: str, snippets: List[str]):
+        async with sem:
+            return await ascore_comprehension(llm, student, concept, snippets)
+    async def grade_student(student: str):
+        todo = [c for c in concepts if (student, c) not in reuse]
+        graded: Dict[str, tuple] = {}
+        if todo:
+            _progress(config, "evaluate", f"Evaluating {student}", student=student, concepts=len(todo))
+            if batch:
+                # one prompt for every concept: chunks retrieved for several concepts are packed and sent once
+                per_concept = pack_contexts({c: contexts[(student, c)] for c in todo}, EVAL_CONTEXT_TOKENS)
+                results = await ascore_comprehension_batch(llm, student, per_concept, sem=sem)
+            else:
+                per_concept = {c: _snippets(contexts[(student, c)]) for c in todo}
+                results = dict(zip(todo, await asyncio.gather(*(one(student, c, per_concept[c]) for c in todo))))
+            graded = {c: (float(results[c].get("score", 0)), results[c].get("pain_points", [])) for c in todo}
+        rows = {c: graded[c] if c in graded else (reuse[(student, c)]["score"], reuse[(student, c)]["pain_points"])
+                for c in concepts}
+        written = [c for c in concepts if c in graded or run_id is not None]
+        if written:
+            buffer["scores"][student] = {c: rows[c][0] for c in written}
+            buffer["pain_points"][student] = {c: rows[c][1] for c in written}
+            buffer["hashes"][student] = {c: _evidence_hash(contexts[(student, c)]) for c in written}
+            if len(buffer["scores"]) >= max(1, EVAL_WRITE_EVERY):
+                await flush()
+        return [rows[c] for c in concepts]
+    try:
+        # gather preserves argument order, so results line up with pairs regardless of completion order
+        per_student = await asyncio.gather(*(grade_student(s) for s in students))
+    finally:
+        await flush()
+    pairs = [(s, c) for s in students for c in concepts]
+    return list(zip(pairs, [r for rs in per_student for r in rs]))
+
+@traced("node.evaluate")
+def node_evaluate(state: PipelineState, config: Optional[RunnableConfig] = None) -> PipelineState:
+    """
+    With state["incremental"], pairs whose retrieved homework chunks match those behind their latest
+    comprehension row keep that score instead of being re-graded.
+    """
+    llm = _llm(state)
     vs = get_vectorstore(state["homework_vector_table"])
     engine = get_engine()
-    scores: Dict[str, Dict[str, float]] = {}
-    pain_points: Dict[str, Dict[str, List[str]]] = {}
-    for student in state["students"]:
-        st.write(f"Evaluating **{student}** …")
-        scores[student] = {}
-        pain_points[student] = {}
-        for concept in state["concepts"]:
-            docs = retrieve_student_context(vs, student, concept, k=6)
-            snippets = [f"[{(d.metadata or {}).get('source_file','?')}] {d.page_content[:600]}" for d in docs]
-            result = score_comprehension(llm, student, concept, snippets)
-            scr = float(result.get("score", 0))
-            pts = result.get("pain_points", [])
-            scores[student][concept] = scr
+    # comprehension rows reference students / concepts, and evaluate is the first node that writes them
+    upsert_students_and_concepts(engine, state["students"], state["concepts"])
+    scores = ScoreMatrix(state["students"], state["concepts"])
+    pain_points: Dict[str, Dict[str, List[str]]] = {s: {} for s in state["students"]}
+    if state["concepts"]:
+        contexts = retrieve_students_context_batch(vs, state["students"], state["concepts"], k=6)
+        reuse: Dict[tuple, Dict[str, Any]] = {}
+        if state.get("incremental"):
+            previous = latest_comprehension(engine, state["students"], state["concepts"])
+            reuse = {pair: row for pair, row in previous.items()
+                     if row["evidence_hash"] and row["evidence_hash"] == _evidence_hash(contexts[pair])}
+            if reuse:
+                _progress(config, "evaluate", f"Reusing {len(reuse)} unchanged score(s)", reused=len(reuse))
+        graded = _run_async(_evaluate_pairs(llm, engine, contexts, state["students"], state["concepts"],
+                                            EVAL_CONCURRENCY, reuse=reuse, config=config, run_id=state.get("run_id")))
+        for (student, concept), (scr, pts) in graded:
+            scores.set(student, concept, scr)
             pain_points[student][concept] = pts
-            write_comprehension(engine, student, concept, scr, pts)
-    state["scores"] = scores
-    state["pain_points"] = pain_points
-    return state
+        refresh_concept_run_stats(engine, state.get("run_id"), state["concepts"], weak_threshold=WEAK_THRESHOLD)
+    # fetched here rather than in a node of its own, so lessons / homework start alongside reports
+    return {"scores": scores, "pain_points": pain_points, "lesson_context": _lesson_context(state, scores)}
 
-def node_reports(state: PipelineState) -> PipelineState:
-    llm = get_llm()
-    engine = get_engine()
-    reports: Dict[str, str] = {}
+def _lesson_context(state: PipelineState, scores: ScoreMatrix) -> Dict[str, List[Any]]:
+    """
+    Run-scoped lesson retrieval: every concept some student is weak on is searched once, at the largest k
+    any downstream node needs; node_lesson_plans / node_homework slice from this.
+    """
+    below = (scores.columns(state["concepts"], fill=0.0) < WEAK_THRESHOLD).any(axis=0)
+    weak = [c for c, b in zip(state["concepts"], below) if b]
+    vs_lessons = get_vectorstore(state["lesson_vector_table"])
+    return prefetch_lesson_context(vs_lessons, weak, k=max(LESSON_PLAN_K, HOMEWORK_K))
+
+def _lesson_docs(state: PipelineState, concept: str, k: int):
+    ctx = state.get("lesson_context") or {}
+    if concept in ctx:
+        return ctx[concept][:k]
+    return get_vectorstore(state["lesson_vector_table"]).similarity_search(concept, k=k)
+
+@traced("node.reports")
+def node_reports(state: PipelineState, config: Optional[RunnableConfig] = None) -> PipelineState:
+    from langchain_core.messages import SystemMessage, HumanMessage
+    llm = _llm(state)
+    prompts = []
     for student in state["students"]:
         results_json = json.dumps({
             "scores": state["scores"][student],
             "pain_points": state["pain_points"][student]
         }, indent=2)
-        from langchain_core.messages import SystemMessage, HumanMessage
-        msgs = [SystemMessage(content=SYSTEM_REPORT),
-                HumanMessage(content=USER_REPORT.format(student_name=student, results_json=results_json))]
-        md = llm.invoke(msgs).content
-        reports[student] = md
-    state["reports"] = reports
-    return state
+        prompts.append([SystemMessage(content=SYSTEM_REPORT),
+                        HumanMessage(content=USER_REPORT.format(student_name=student, results_json=results_json))])
+    engine, run_id = get_engine(), state.get("run_id")
+    reports, unsaved = _generate(llm, prompts, state["students"], "reports", config,
+                                 lambda r: write_reports(engine, r, run_id=run_id))
+    if unsaved:
+        write_reports(engine, unsaved, run_id=run_id)
+    return {"reports": reports}
 
+@traced("node.kg_groups")
 def node_knowledge_graph_and_groups(state: PipelineState) -> PipelineState:
     engine = get_engine()
-    upsert_students_and_concepts(engine, state["students"], state["concepts"])
-    write_student_concepts(engine, state["scores"])
+    write_student_concepts(engine, state["scores"], run_id=state.get("run_id"))
     groups = build_study_groups(state["scores"], state["concepts"], target_size=2)
-    write_study_groups(engine, groups)
-    state["groups"] = groups
-    return state
+    write_study_groups(engine, groups, run_id=state.get("run_id"))
+    return {"groups": groups}
 
-def node_lesson_plans(state: PipelineState) -> PipelineState:
-    llm = get_llm()
-    vs_lessons = get_vectorstore(state["lesson_vector_table"])
-    weak = []
-    for c in state["concepts"]:
-        vals = [state["scores"][s].get(c, 0) for s in state["students"]]
-        vals.sort()
-        med = vals[len(vals)//2]
-        if med < 70:
-            weak.append(c)
-    plans: Dict[str, str] = {}
+@traced("node.lessons")
+def node_lesson_plans(state: PipelineState, config: Optional[RunnableConfig] = None) -> PipelineState:
+    from langchain_core.messages import SystemMessage, HumanMessage
+    llm = _llm(state)
+    medians = _score_matrix(state).median()
+    weak = [c for c in state["concepts"] if medians.get(c, 0.0) < WEAK_THRESHOLD]
+    prompts = []
     for c in weak:
-        ctx_docs = vs_lessons.similarity_search(c, k=6)
-        ctx_text = "\n---\n".join([d.page_content[:600] for d in ctx_docs])
-        from langchain_core.messages import SystemMessage, HumanMessage
-        msgs = [SystemMessage(content=SYSTEM_LESSON),
-                HumanMessage(content=USER_LESSON.format(weak_concepts=", ".join([c]), context=ctx_text))]
-        plan = llm.invoke(msgs).content
-        plans[c] = plan
-    write_lesson_plans(get_engine(), plans)
-    state["lesson_plans"] = plans
-    return state
-
-def node_homework(state: PipelineState) -> PipelineState:
-    llm = get_llm()
-    vs_lessons = get_vectorstore(state["lesson_vector_table"])
+        ctx_docs = _lesson_docs(state, c, LESSON_PLAN_K)
+        ctx_text = "\n---\n".join(pack_context(ctx_docs, LESSON_CONTEXT_TOKENS, tag_sources=False))
+        prompts.append([SystemMessage(content=SYSTEM_LESSON),
+                        HumanMessage(content=USER_LESSON.format(weak_concepts=", ".join([c]), context=ctx_text))])
+    engine, run_id = get_engine(), state.get("run_id")
+    plans, unsaved = _generate(llm, prompts, weak, "lessons", config,
+                               lambda p: write_lesson_plans(engine, p, run_id=run_id))
+    if unsaved:
+        write_lesson_plans(engine, unsaved, run_id=run_id)
+    return {"lesson_plans": plans}
+
+@traced("node.homework")
+def node_homework(state: PipelineState, config: Optional[RunnableConfig] = None) -> PipelineState:
+    from langchain_core.messages import SystemMessage, HumanMessage
+    llm = _llm(state)
     homework: Dict[str, str] = {}
+    todo, prompts = [], []
+    weak_by_student = _score_matrix(state).weak_by_student(WEAK_THRESHOLD)
     for s in state["students"]:
-        weak = [c for c, v in state["scores"][s].items() if v < 70]
+        weak = weak_by_student.get(s, [])
         if not weak:
             homework[s] = "🎉 Great job! No targeted homework—consider enrichment tasks from lesson resources."
             continue
-        ctx = []
-        for c in weak:
-            docs = vs_lessons.similarity_search(c, k=3)
-            ctx.extend([d.page_content[:400] for d in docs])
-        context = "\n---\n".join(ctx[:1200])
-        from langchain_core.messages import SystemMessage, HumanMessage
-        msgs = [SystemMessage(content=SYSTEM_HW),
-                HumanMessage(content=USER_HW.format(student_name=s, weak_concepts=", ".join(weak), context=context))]
-        hw = llm.invoke(msgs).content
-        homework[s] = hw
-    write_homework(get_engine(), homework)
-    state["homework"] = homework
-    return state
-
-def build_graph():
+        # round-robin across weak concepts so one shared budget covers all of them
+        docs = interleave([_lesson_docs(state, c, HOMEWORK_K) for c in weak])
+        context = "\n---\n".join(pack_context(docs, HOMEWORK_CONTEXT_TOKENS, rank="order", tag_sources=False))
+        todo.append(s)
+        prompts.append([SystemMessage(content=SYSTEM_HW),
+                        HumanMessage(content=USER_HW.format(student_name=s, weak_concepts=", ".join(weak), context=context))])
+    engine, run_id = get_engine(), state.get("run_id")
+    generated, unsaved = _generate(llm, prompts, todo, "homework", config,
+                                   lambda hw: write_homework(engine, hw, run_id=run_id))
+    homework.update(generated)
+    homework = {s: homework[s] for s in state["students"]}
+    unsaved = {s: hw for s, hw in homework.items() if s in unsaved or s not in generated}
+    if unsaved:
+        write_homework(engine, unsaved, run_id=run_id)
+    return {"homework": homework}
+
+def build_graph(checkpointer=None):
+    """
+    evaluate fans out to reports, kg_groups, lessons and homework in one superstep; the graph ends
+    once every branch has finished, so post-evaluation time is that of the slowest branch.
+    With a checkpointer, every finished node is persisted per thread_id (see run_pipeline).
+    """
     g = StateGraph(PipelineState)
     g.add_node("ingest", node_ingest)
     g.add_node("evaluate", node_evaluate)
@@ -125,9 +327,68 @@ def build_graph():
     g.add_node("homework", node_homework)
     g.set_entry_point("ingest")
     g.add_edge("ingest", "evaluate")
-    g.add_edge("evaluate", "reports")
-    g.add_edge("reports", "kg_groups")
-    g.add_edge("kg_groups", "lessons")
-    g.add_edge("lessons", "homework")
-    g.add_edge("homework", END)
-    return g.compile()
+    for leaf in ("reports", "kg_groups", "lessons", "homework"):
+        g.add_edge("evaluate", leaf)
+    for leaf in ("reports", "kg_groups", "lessons", "homework"):
+        g.add_edge(leaf, END)
+    return g.compile(checkpointer=checkpointer)
+
+_checkpointer = None
+_checkpointer_lock = threading.Lock()
+
+def open_checkpointer(path: str) -> SqliteSaver:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+
+def get_checkpointer() -> SqliteSaver:
+    global _checkpointer
+    with _checkpointer_lock:
+        if _checkpointer is None:
+            _checkpointer = open_checkpointer(PIPELINE_CHECKPOINT_PATH)
+        return _checkpointer
+
+def pipeline_thread_id(init: PipelineState) -> str:
+    """
+    Same class inputs -> same checkpoint thread, so an interrupted run can be picked up again.
+    """
+    key = json.dumps({k: init.get(k) for k in ("students", "concepts", "homework_vector_table", "lesson_vector_table")},
+                     sort_keys=True)
+    return "run-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+def pending_nodes(init: PipelineState, checkpointer=None) -> tuple:
+    """
+    Nodes still to run for an interrupted run of these inputs (empty if the last run completed).
+    """
+    graph = build_graph(checkpointer or get_checkpointer())
+    return graph.get_state({"configurable": {"thread_id": pipeline_thread_id(init)}}).next
+
+def run_pipeline(init: PipelineState, checkpointer=None, resume: bool = True, on_step=None, progress=None,
+                 on_token=None) -> PipelineState:
+    """
+    Runs the graph under a durable checkpointer; an interrupted run for the same inputs resumes after
+    its last completed node instead of starting over.
+    - The run is traced (tooling/instrumentation.py) unless the caller already opened a trace.
+    - on_step(update) is called in the calling thread after every graph step (e.g. to refresh a UI panel).
+    - progress(event) receives in-node progress events ({"node", "message", ...}), possibly from worker threads.
+    - on_token(event) turns on token streaming for reports, lesson plans and homework: it is called in the
+      calling thread with {"node", "key", "delta"} per chunk and {"node", "key", "text", "done": True} per
+      finished text (already persisted by then).
+    """
+    graph = build_graph(checkpointer or get_checkpointer())
+    config = {"configurable": {"thread_id": pipeline_thread_id(init)}}
+    if progress is not None:
+        config["configurable"]["progress"] = progress
+    if on_token is not None:
+        config["configurable"]["stream_tokens"] = True
+    # a fresh run on an existing thread must not inherit the previous run's id from the checkpoint
+    inputs = None if resume and graph.get_state(config).next else {**init, "run_id": init.get("run_id") or new_run_id()}
+    with trace_run("pipeline", {"pipeline.thread_id": config["configurable"]["thread_id"]}):
+        if on_step is None and on_token is None:
+            return graph.invoke(inputs, config)
+        for mode, chunk in graph.stream(inputs, config, stream_mode=["updates", "custom"]):
+            if mode == "custom":
+                on_token(chunk)
+            elif on_step is not None:
+                on_step(chunk)
+        return graph.get_state(config).values
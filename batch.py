@@ -0,0 +1,215 @@
+"""
+Headless batch runner: grades many classes from a manifest, no Streamlit involved.
+
+    python batch.py manifest.json --workers 4 --out results/ [--shard 0/3] [--rps 5]
+
+Manifest (JSON):
+    {"defaults": {"concepts": [...], "homework_vector_table": "homework_vector", "lesson_vector_table": "lesson_vector"},
+     "classes": [{"id": "7a-science", "students": [...], "concepts": [...], ...}, ...]}
+With "per_class_tables": true a class reads homework from <homework_vector_table>_<id> (tidb.class_table).
+Every class runs through the compiled graph (agent.run_pipeline) in a process pool; all workers draw LLM
+requests from one shared rate limit. Results are written to TiDB by the graph and to <out>/<id>.json here.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import TypedDict, List, Dict, Any, Optional, Callable
+from agent import run_pipeline, open_checkpointer, PipelineState
+from tooling.rate_limit import SharedRateLimiter, set_rate_limiter, LLM_REQUESTS_PER_SECOND, LLM_RATE_BURST
+from tooling.score_matrix import ScoreMatrix
+from tooling.tidb import get_engine, ensure_relational_schema, class_table
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+BATCH_CHECKPOINT_DIR = os.getenv("BATCH_CHECKPOINT_DIR", ".cache/batch_checkpoints")
+REQUIRED_KEYS = ("students", "concepts", "homework_vector_table", "lesson_vector_table")
+
+_events = None  # worker side: queue back to the parent's progress listener
+
+
+def load_manifest(path: str) -> List[Dict[str, Any]]:
+    """
+    Classes with the manifest defaults applied; a bare JSON list of classes is accepted too.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"classes": data}
+    defaults = {"homework_vector_table": os.getenv("VECTOR_TABLE", "homework_vector"),
+                "lesson_vector_table": os.getenv("LESSON_VECTOR_TABLE", "lesson_vector"),
+                **data.get("defaults", {})}
+    classes, seen = [], set()
+    for i, spec in enumerate(data.get("classes", [])):
+        spec = {**defaults, **spec}
+        spec.setdefault("id", f"class-{i}")
+        if spec.get("per_class_tables"):
+            spec["homework_vector_table"] = class_table(spec["homework_vector_table"], spec["id"])
+        missing = [k for k in REQUIRED_KEYS if not spec.get(k)]
+        if missing:
+            raise ValueError(f"class {spec['id']!r} is missing {', '.join(missing)}")
+        if spec["id"] in seen:
+            raise ValueError(f"duplicate class id {spec['id']!r}")
+        seen.add(spec["id"])
+        classes.append(spec)
+    return classes
+
+def shard(classes: List[Dict[str, Any]], index: int, count: int) -> List[Dict[str, Any]]:
+    """
+    This machine's share: a class belongs to shard sha256(id) % count, whatever the manifest order.
+    """
+    return [c for c in classes if int(hashlib.sha256(c["id"].encode("utf-8")).hexdigest(), 16) % count == index]
+
+
+def _init_worker(limiter, events):
+    global _events
+    _events = events
+    set_rate_limiter(limiter)
+
+def _emit(event: Dict[str, Any]):
+    if _events is not None:
+        _events.put(event)
+
+def _jsonable(out: Dict[str, Any]) -> Dict[str, Any]:
+    scores = out.get("scores")
+    return {
+        "run_id": out.get("run_id"),
+        "scores": scores.to_dict() if isinstance(scores, ScoreMatrix) else (scores or {}),
+        "pain_points": out.get("pain_points", {}),
+        "reports": out.get("reports", {}),
+        "groups": {str(k): v for k, v in (out.get("groups") or {}).items()},
+        "lesson_plans": out.get("lesson_plans", {}),
+        "homework": out.get("homework", {}),
+    }
+
+def run_class(spec: Dict[str, Any], out_dir: str, incremental: bool = True, bypass_llm_cache: bool = False,
+              checkpoint_dir: str = BATCH_CHECKPOINT_DIR) -> Dict[str, Any]:
+    """
+    One class through the graph (top-level so pool workers can run it). Each class checkpoints to its own
+    SQLite file, so a re-run of the batch resumes interrupted classes without workers sharing a database.
+    """
+    cid = spec["id"]
+    started = time.perf_counter()
+    init: PipelineState = {
+        "students": list(spec["students"]),
+        "concepts": list(spec["concepts"]),
+        "homework_vector_table": spec["homework_vector_table"],
+        "lesson_vector_table": spec["lesson_vector_table"],
+        "bypass_llm_cache": bypass_llm_cache,
+        "incremental": incremental,
+    }
+    _emit({"class": cid, "node": "start", "message": f"{len(init['students'])} students x {len(init['concepts'])} concepts"})
+    checkpointer = None
+    try:
+        checkpointer = open_checkpointer(os.path.join(checkpoint_dir, f"{cid}.sqlite"))
+        out = run_pipeline(
+            init,
+            checkpointer=checkpointer,
+            on_step=lambda update: _emit({"class": cid, "node": ",".join(update), "message": "done"}),
+            progress=lambda event: _emit({"class": cid, **event}),
+        )
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, f"{cid}.json")
+        with open(path, "w") as f:
+            json.dump({"id": cid, "students": init["students"], "concepts": init["concepts"], **_jsonable(out)}, f, indent=2)
+        return {"id": cid, "status": "ok", "run_id": out.get("run_id"), "seconds": round(time.perf_counter() - started, 2),
+                "output": path}
+    except Exception as e:
+        return {"id": cid, "status": "error", "seconds": round(time.perf_counter() - started, 2),
+                "error": f"{type(e).__name__}: {e}"}
+    finally:
+        if checkpointer is not None:
+            checkpointer.conn.close()  # one SQLite file per class; a long batch must not hold them all open
+
+
+def print_progress(event: Dict[str, Any]):
+    print(f"[{event.get('class', '?')}] {event.get('node', '')}: {event.get('message', '')}", flush=True)
+
+def run_batch(classes: List[Dict[str, Any]], out_dir: str, workers: int = os.cpu_count() or 1,
+              requests_per_second: float = LLM_REQUESTS_PER_SECOND, burst: int = LLM_RATE_BURST,
+              on_progress: Optional[Callable[[Dict[str, Any]], None]] = print_progress,
+              runner: Callable[..., Dict[str, Any]] = run_class, **runner_kwargs) -> List[Dict[str, Any]]:
+    """
+    Runs every class in a spawn-context process pool and returns one summary per class (manifest order).
+    - requests_per_second > 0 installs a SharedRateLimiter that all workers draw from.
+    - on_progress(event) is called in this process, from a listener thread, for every worker event.
+    - workers <= 1 runs the classes in this process (same code path, easier to debug).
+    """
+    ctx = multiprocessing.get_context("spawn")
+    limiter = SharedRateLimiter(requests_per_second, burst, ctx=ctx) if requests_per_second > 0 else None
+    events = ctx.Queue()
+    listener = threading.Thread(target=_listen, args=(events, on_progress), daemon=True)
+    listener.start()
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        if workers <= 1:
+            _init_worker(limiter, events)
+            for spec in classes:
+                results[spec["id"]] = runner(spec, out_dir, **runner_kwargs)
+                events.put({"class": spec["id"], "node": "finished", "message": results[spec["id"]]["status"]})
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(classes)) or 1, mp_context=ctx,
+                                     initializer=_init_worker, initargs=(limiter, events)) as pool:
+                futures = {pool.submit(runner, spec, out_dir, **runner_kwargs): spec["id"] for spec in classes}
+                for fut in as_completed(futures):
+                    cid = futures[fut]
+                    try:
+                        results[cid] = fut.result()
+                    except Exception as e:  # the worker process itself died
+                        results[cid] = {"id": cid, "status": "error", "error": f"{type(e).__name__}: {e}"}
+                    events.put({"class": cid, "node": "finished", "message": results[cid]["status"]})
+    finally:
+        events.put(None)
+        listener.join()
+    return [results[spec["id"]] for spec in classes]
+
+def _listen(events, on_progress):
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        if on_progress is not None:
+            try:
+                on_progress(event)
+            except Exception:
+                pass  # a broken progress sink must not stop the batch
+
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(description="Grade many classes from a manifest without the Streamlit UI.")
+    p.add_argument("manifest", help="JSON manifest of classes")
+    p.add_argument("--out", default="results", help="directory for <class id>.json and summary.json")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes (<= 1: run in-process)")
+    p.add_argument("--rps", type=float, default=LLM_REQUESTS_PER_SECOND,
+                   help="LLM requests per second shared by all workers on this machine (0 = unlimited)")
+    p.add_argument("--burst", type=int, default=LLM_RATE_BURST)
+    p.add_argument("--shard", default="0/1", help="i/n: run only this machine's share of the manifest")
+    p.add_argument("--full", action="store_true", help="re-grade everything instead of reusing unchanged scores")
+    p.add_argument("--bypass-llm-cache", action="store_true")
+    p.add_argument("--no-schema", action="store_true", help="skip ensure_relational_schema")
+    args = p.parse_args(argv)
+
+    index, count = (int(x) for x in args.shard.split("/"))
+    classes = shard(load_manifest(args.manifest), index, count)
+    if not classes:
+        print("nothing to do for this shard")
+        return 0
+    if not args.no_schema:
+        ensure_relational_schema(get_engine())
+    started = time.perf_counter()
+    summary = run_batch(classes, args.out, workers=args.workers, requests_per_second=args.rps, burst=args.burst,
+                        incremental=not args.full, bypass_llm_cache=args.bypass_llm_cache)
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, "summary.json"), "w") as f:
+        json.dump({"shard": args.shard, "seconds": round(time.perf_counter() - started, 2), "classes": summary}, f, indent=2)
+    failed = [s for s in summary if s["status"] != "ok"]
+    print(f"{len(summary) - len(failed)}/{len(summary)} classes done in {time.perf_counter() - started:.1f}s"
+          + (f"; failed: {', '.join(s['id'] for s in failed)}" if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
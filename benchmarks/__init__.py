@@ -0,0 +1,8 @@
+"""
+Offline benchmarks: the LangGraph pipeline on synthetic cohorts with OpenAI and TiDB replaced by
+deterministic stand-ins (benchmarks/fakes.py). Run from the repo root: python -m benchmarks --help
+"""
+import os
+
+# tooling/* copies OPENAI_API_KEY into os.environ at import time; nothing here ever calls OpenAI
+os.environ.setdefault("OPENAI_API_KEY", "sk-offline-benchmark")
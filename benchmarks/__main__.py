@@ -0,0 +1,53 @@
+from .harness import PROFILES, default_config, run_benchmark, format_report, baseline_path, load_baseline, save_baseline, compare, overlap_flags
+import argparse
+import json
+import sys
+
+
+def main(argv=None) -> int:
+    defaults = default_config()
+    p = argparse.ArgumentParser(prog="python -m benchmarks", description="Offline pipeline benchmark (fake LLM, embeddings and TiDB).")
+    p.add_argument("--profile", choices=sorted(PROFILES), default=defaults["profile"])
+    p.add_argument("--students", type=int, help="override the profile's cohort size")
+    p.add_argument("--concepts", type=int)
+    p.add_argument("--pdfs", type=int, help="homework PDFs per student (cycled from sample/*.pdf)")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--llm-latency", type=float, default=defaults["llm_latency"], help="seconds per LLM call")
+    p.add_argument("--llm-token-latency", type=float, default=defaults["llm_token_latency"], help="seconds per output token")
+    p.add_argument("--llm-output-tokens", type=int, default=defaults["llm_output_tokens"])
+    p.add_argument("--embed-latency", type=float, default=defaults["embed_latency"], help="seconds per embedding request")
+    p.add_argument("--sql-latency", type=float, default=defaults["sql_latency"], help="seconds per SQL round trip")
+    p.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    p.add_argument("--baseline", help="baseline JSON (default: benchmarks/baselines/<profile>.json)")
+    p.add_argument("--save-baseline", action="store_true", help="write this result as the baseline instead of comparing")
+    p.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown for wall time / memory")
+    p.add_argument("--json", dest="json_out", help="also write the full result to this file")
+    args = p.parse_args(argv)
+
+    config = {k: v for k, v in vars(args).items() if k in defaults or k in ("students", "concepts", "pdfs")}
+    result = run_benchmark(config, repeat=args.repeat, memory=not args.no_memory)
+    print(format_report(result))
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    path = args.baseline or baseline_path(args.profile)
+    if args.save_baseline:
+        print(f"baseline saved to {save_baseline(result, path)}")
+        return 0
+    baseline = load_baseline(path)
+    if baseline is None:
+        print(f"no baseline at {path} (create one with --save-baseline)")
+        for f in overlap_flags(result):
+            print("REGRESSION " + f)
+        return 1 if overlap_flags(result) else 0
+    flags = compare(result, baseline, tolerance=args.tolerance)
+    regressions = [f for f in flags if not f.startswith("note:")]
+    for f in flags:
+        print(("REGRESSION " if f in regressions else "") + f)
+    if not flags:
+        print(f"no regressions against {path}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
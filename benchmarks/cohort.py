@@ -0,0 +1,90 @@
+from langchain_core.documents import Document
+from dataclasses import dataclass, field
+from typing import TypedDict, List, Dict, Any, Optional
+from tooling.vector_search import split_pdf_bytes
+import glob
+import os
+import random
+import uuid
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample")
+LESSON_PDF = "Lesson.pdf"
+
+BASE_CONCEPTS = [
+    "photosynthesis", "cell respiration", "newton laws", "fractions", "plate tectonics", "chemical bonding",
+    "supply and demand", "electric circuits", "water cycle", "genetics", "probability", "poetry meter",
+]
+FILLER = ("the student explains that because therefore however example shows result process energy model "
+          "change system evidence question answer method value reason").split()
+
+PROFILES: Dict[str, Dict[str, int]] = {
+    "tiny": {"students": 4, "concepts": 3, "pdfs": 1},
+    "small": {"students": 20, "concepts": 6, "pdfs": 2},
+    "medium": {"students": 100, "concepts": 12, "pdfs": 2},
+    "large": {"students": 500, "concepts": 20, "pdfs": 3},
+}
+
+
+@dataclass
+class Cohort:
+    students: List[str]
+    concepts: List[str]
+    homework_docs: List[Document] = field(default_factory=list)
+    lesson_docs: List[Document] = field(default_factory=list)
+
+
+def _paragraph(rng: random.Random, topic: str, words: int = 120) -> str:
+    body = [rng.choice(FILLER) for _ in range(words)]
+    for i in range(0, words, 15):
+        body[i] = topic
+    return " ".join(body)
+
+def _sample_pdf_docs(sample_dir: str) -> Dict[str, List[Document]]:
+    # each sample PDF is parsed once, the real way; students get relabelled copies
+    out = {}
+    for path in sorted(glob.glob(os.path.join(sample_dir, "*.pdf"))):
+        with open(path, "rb") as f:
+            out[os.path.basename(path)] = split_pdf_bytes(os.path.basename(path), f.read(), "")
+    return out
+
+def _relabel(docs: List[Document], student: str, source_file: str) -> List[Document]:
+    out = []
+    for i, d in enumerate(docs):
+        meta = {**d.metadata, "student_name": student, "source_file": source_file, "source": source_file}
+        # same id scheme as split_pdf_bytes, so the ingest code sees realistic ids
+        doc_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{student}|{source_file}|{meta['file_hash']}|{i}"))
+        out.append(Document(id=doc_id, page_content=d.page_content, metadata=meta))
+    return out
+
+def synthetic_cohort(students: int, concepts: int, pdfs: int, seed: int = 0, sample_dir: str = SAMPLE_DIR) -> Cohort:
+    """
+    students x concepts x PDFs of homework plus a lesson corpus.
+    - Every student gets `pdfs` homework files cycled from sample/*.pdf (parsed with the app's own splitter)
+      and one synthetic notes file with a paragraph per concept, so retrieval has relevant chunks.
+    - Lessons are sample/Lesson.pdf plus two synthetic lesson paragraphs per concept.
+    """
+    rng = random.Random(seed)
+    names = [f"student_{i:04d}" for i in range(students)]
+    topics = [BASE_CONCEPTS[i] if i < len(BASE_CONCEPTS) else f"concept {i}" for i in range(concepts)]
+    samples = _sample_pdf_docs(sample_dir)
+    homework_files = [n for n in samples if n != LESSON_PDF]
+    cohort = Cohort(names, topics)
+    for s_idx, s in enumerate(names):
+        for p in range(pdfs if homework_files else 0):
+            src = homework_files[(s_idx + p) % len(homework_files)]
+            cohort.homework_docs.extend(_relabel(samples[src], s, f"{p}_{src}"))
+        for c in topics:
+            cohort.homework_docs.append(Document(
+                id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{s}|notes|{c}")),
+                page_content=_paragraph(rng, c),
+                metadata={"student_name": s, "source_file": "notes.txt", "source": "notes.txt"},
+            ))
+    cohort.lesson_docs.extend(samples.get(LESSON_PDF, []))
+    for c in topics:
+        for j in range(2):
+            cohort.lesson_docs.append(Document(
+                id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"lesson|{c}|{j}")),
+                page_content=_paragraph(rng, c, words=200),
+                metadata={"source_file": "lesson_notes.txt", "source": "lesson_notes.txt"},
+            ))
+    return cohort
@@ -0,0 +1,340 @@
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_core.documents import Document
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import TypedDict, List, Dict, Any, Optional, Iterable
+from tooling.agent_capabilities import SYSTEM_SCORER, SYSTEM_SCORER_BATCH
+import numpy as np
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+import zlib
+
+# Node currently executing (set by the harness); counters are attributed to it.
+# Work on threads that do not inherit the context (e.g. plain ThreadPoolExecutor) lands in "(unattributed)".
+current_node: ContextVar[str] = ContextVar("benchmark_node", default="(unattributed)")
+
+
+class Meter:
+    """
+    Thread-safe counters per (node, metric): llm_calls, input_tokens, output_tokens, embed_calls,
+    embedded_texts, sql_round_trips, sql_rows.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, Counter] = defaultdict(Counter)
+
+    def add(self, metric: str, n: int = 1):
+        with self._lock:
+            self.counts[current_node.get()][metric] += n
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {node: dict(c) for node, c in self.counts.items()}
+
+
+def _stable_int(*parts: str) -> int:
+    return int.from_bytes(hashlib.sha256("\x00".join(parts).encode("utf-8")).digest()[:8], "big")
+
+def fake_score(student: str, concept: str) -> int:
+    # deterministic spread over 35-99, so every run has the same mix of weak and strong pairs
+    return 35 + _stable_int(student, concept) % 65
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Stand-in for get_llm(): sleeps latency + output_tokens * token_latency per call and answers
+    grader prompts with well-formed, deterministic JSON (other prompts get filler text).
+    """
+    latency: float = 0.2
+    token_latency: float = 0.0
+    output_tokens: int = 300
+    meter: Optional[Any] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark-chat"
+
+    def _answer(self, messages) -> ChatResult:
+        system = messages[0].content if messages else ""
+        prompt = "\n".join(str(m.content) for m in messages)
+        student = (re.search(r"^Student: (.*)$", prompt, re.M) or [None, ""])[1]
+        if system == SYSTEM_SCORER_BATCH:
+            concepts = json.loads(re.search(r"^Target Concepts: (.*)$", prompt, re.M)[1])
+            content = json.dumps({c: {"score": fake_score(student, c), "pain_points": [f"gap in {c}"], "evidence": []}
+                                  for c in concepts})
+        elif system == SYSTEM_SCORER:
+            concept = re.search(r'^Target Concept: "(.*)"$', prompt, re.M)[1]
+            content = json.dumps({"score": fake_score(student, concept), "pain_points": [f"gap in {concept}"], "evidence": []})
+        else:
+            content = " ".join(f"token{i}" for i in range(self.output_tokens))
+        usage = {"input_tokens": _count_tokens(prompt), "output_tokens": self.output_tokens}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        if self.meter is not None:
+            self.meter.add("llm_calls")
+            self.meter.add("input_tokens", usage["input_tokens"])
+            self.meter.add("output_tokens", usage["output_tokens"])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    def _delay(self) -> float:
+        return self.latency + self.output_tokens * self.token_latency
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self._delay())
+        return self._answer(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self._delay())
+        return self._answer(messages)
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Stand-in for get_embeddings(): feature-hashed bag of words, so chunks that mention a concept
+    really are nearer to it. Sleeps latency per request + text_latency per text.
+    """
+
+    def __init__(self, dim: int = 256, latency: float = 0.02, text_latency: float = 0.0, meter: Optional[Meter] = None):
+        self.dim = dim
+        self.latency = latency
+        self.text_latency = text_latency
+        self.meter = meter
+        self.model = f"fake-hashing-{dim}"
+
+    def _vector(self, text: str) -> List[float]:
+        words = re.findall(r"[a-z0-9]+", text.lower())
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for w in words:
+            h = zlib.crc32(w.encode("utf-8"))
+            vec[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = float(np.linalg.norm(vec))
+        return (vec / norm if norm else vec).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency + self.text_latency * len(texts))
+        if self.meter is not None:
+            self.meter.add("embed_calls")
+            self.meter.add("embedded_texts", len(texts))
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+@dataclass
+class FakeQueryResult:
+    id: str
+    document: str
+    metadata: dict
+    distance: float
+
+
+class FakeBackend:
+    """
+    The "database": vector tables by name, one round-trip latency, and the meter every stand-in reports to.
+    """
+
+    def __init__(self, sql_latency: float = 0.01, meter: Optional[Meter] = None):
+        self.sql_latency = sql_latency
+        self.meter = meter or Meter()
+        self.tables: Dict[str, "InMemoryVectorClient"] = {}
+
+    def round_trip(self, rows: int = 0):
+        time.sleep(self.sql_latency)
+        self.meter.add("sql_round_trips")
+        if rows:
+            self.meter.add("sql_rows", rows)
+
+    def table(self, name: str) -> "InMemoryVectorClient":
+        if name not in self.tables:
+            self.tables[name] = InMemoryVectorClient(name, self)
+        return self.tables[name]
+
+
+class InMemoryVectorClient:
+    """
+    Mirrors the parts of TiDBVectorClient the app uses (_table_name, insert, query); every call is one round trip.
+    """
+
+    def __init__(self, table_name: str, backend: FakeBackend):
+        self._table_name = table_name
+        self.backend = backend
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[dict] = []
+        self._vectors: List[np.ndarray] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def insert(self, texts: List[str], embeddings: List[List[float]], metadatas: Optional[List[dict]] = None,
+               ids: Optional[List[str]] = None, **kwargs) -> List[str]:
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        self.backend.round_trip(rows=len(texts))
+        self.ids.extend(ids)
+        self.documents.extend(texts)
+        self.metadatas.extend(dict(m or {}) for m in metadatas)
+        self._vectors.extend(np.asarray(e, dtype=np.float32) for e in embeddings)
+        self._matrix = None
+        return ids
+
+    def _distances(self, query_vector: List[float]) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix = np.vstack(self._vectors) if self._vectors else np.zeros((0, 1), dtype=np.float32)
+        if not len(self._matrix):
+            return np.zeros(0, dtype=np.float32)
+        q = np.asarray(query_vector, dtype=np.float32)
+        norms = np.linalg.norm(self._matrix, axis=1) * (np.linalg.norm(q) or 1.0)
+        return 1.0 - (self._matrix @ q) / np.where(norms == 0, 1.0, norms)
+
+    def _result(self, i: int, distance: float) -> FakeQueryResult:
+        return FakeQueryResult(self.ids[i], self.documents[i], dict(self.metadatas[i]), float(distance))
+
+    def query(self, query_vector: List[float], k: int = 5, filter: Optional[dict] = None, **kwargs) -> List[FakeQueryResult]:
+        self.backend.round_trip()
+        dist = self._distances(query_vector)
+        order = np.argsort(dist, kind="stable")
+        out = []
+        for i in order:
+            if filter and any(self.metadatas[i].get(key) != v for key, v in filter.items()):
+                continue
+            out.append(self._result(i, dist[i]))
+            if len(out) == k:
+                break
+        return out
+
+    def top_k_per_student(self, query_vector: List[float], students: Iterable[str], k: int) -> List[FakeQueryResult]:
+        # what the ROW_NUMBER() window query in retrieve_students_context_batch returns, already ordered by (student, distance)
+        wanted = set(students)
+        dist = self._distances(query_vector)
+        per: Dict[str, List[FakeQueryResult]] = defaultdict(list)
+        for i in np.argsort(dist, kind="stable"):
+            s = self.metadatas[i].get("student_name")
+            if s in wanted and len(per[s]) < k:
+                per[s].append(self._result(i, dist[i]))
+        return [r for s in sorted(per) for r in per[s]]
+
+
+class InMemoryVectorStore(VectorStore):
+    """
+    Stand-in for get_vectorstore(): a LangChain VectorStore whose tidb_vector_client is an InMemoryVectorClient.
+    """
+
+    def __init__(self, table_name: str, embedding: Embeddings, backend: FakeBackend):
+        self._embedding = embedding
+        self.tidb_vector_client = backend.table(table_name)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None,
+                  **kwargs) -> List[str]:
+        texts = list(texts)
+        return self.tidb_vector_client.insert(texts, self._embedding.embed_documents(texts), metadatas, ids)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs) -> List[Document]:
+        results = self.tidb_vector_client.query(self._embedding.embed_query(query), k=k, filter=filter)
+        return [Document(id=r.id, page_content=r.document, metadata={**r.metadata, "distance": r.distance}) for r in results]
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        store = cls(kwargs.get("table_name", "benchmark"), embedding, kwargs.get("backend") or FakeBackend())
+        store.add_texts(texts, metadatas)
+        return store
+
+
+class FakeResult:
+    def __init__(self, rows: Optional[List[Any]] = None):
+        self._rows = rows or []
+        self.rowcount = len(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def fetchall(self) -> List[Any]:
+        return list(self._rows)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    first = fetchone
+
+    def scalar(self):
+        return self._rows[0][0] if self._rows else None
+
+
+@dataclass
+class _WindowRow:
+    id: str
+    document: str
+    meta: str
+    sname: str
+    distance: float
+
+
+class FakeConnection:
+    """
+    Each execute() is one round trip. Reads come back empty, except the per-concept window query of
+    retrieve_students_context_batch, which is answered from the in-memory vector table.
+    """
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def execute(self, stmt, params=None):
+        sql = str(stmt)
+        self.backend.round_trip(rows=len(params) if isinstance(params, list) else 0)
+        if "VEC_COSINE_DISTANCE" in sql and isinstance(params, dict):
+            table = re.search(r"FROM\s+`?([A-Za-z0-9_]+)`?\s+WHERE", sql)[1]
+            results = self.backend.table(table).top_k_per_student(json.loads(params["q"]), params["students"], params["k"])
+            return FakeResult([_WindowRow(r.id, r.document, json.dumps(r.metadata), r.metadata.get("student_name"),
+                                          r.distance) for r in results])
+        return FakeResult()
+
+
+class FakeEngine:
+    """
+    Stand-in for get_engine(): begin()/connect() hand out FakeConnections on the shared backend.
+    """
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    def begin(self) -> FakeConnection:
+        return FakeConnection(self.backend)
+
+    def connect(self) -> FakeConnection:
+        return FakeConnection(self.backend)
+
+    def dispose(self):
+        pass
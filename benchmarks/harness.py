@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+from typing import TypedDict, List, Dict, Any, Optional
+from .fakes import Meter, FakeBackend, FakeChatModel, FakeEmbeddings, FakeEngine, InMemoryVectorStore, current_node
+from .cohort import Cohort, PROFILES, synthetic_cohort
+import agent
+import tooling.vector_search as vector_search
+import functools
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+
+HOMEWORK_TABLE = "bench_homework"
+LESSON_TABLE = "bench_lessons"
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+# graph node name -> function in agent.py (build_graph looks these up when it is called)
+NODES = {
+    "ingest": "node_ingest",
+    "evaluate": "node_evaluate",
+    "reports": "node_reports",
+    "kg_groups": "node_knowledge_graph_and_groups",
+    "lessons": "node_lesson_plans",
+    "homework": "node_homework",
+}
+# branch -> branch it must overlap with: both leave evaluate in the same superstep, so the first has to start
+# before the second finishes (a barrier in between would serialize them)
+OVERLAPS = {"lessons": "reports", "homework": "reports"}
+COUNT_METRICS = ("llm_calls", "input_tokens", "output_tokens", "embed_calls", "embedded_texts", "sql_round_trips", "sql_rows")
+
+
+def default_config() -> Dict[str, Any]:
+    return {
+        "profile": "small",
+        "llm_latency": 0.2,
+        "llm_token_latency": 0.0,
+        "llm_output_tokens": 300,
+        "embed_latency": 0.02,
+        "embed_dim": 256,
+        "sql_latency": 0.01,
+        "seed": 0,
+    }
+
+
+@contextmanager
+def offline(config: Dict[str, Any], meter: Meter, timings: Dict[str, tuple]):
+    """
+    Points agent.py / tooling.vector_search at the stand-ins and wraps every node with a timer
+    (timings[label] = (start, end) on the perf_counter clock).
+    Everything is restored on exit.
+    """
+    backend = FakeBackend(sql_latency=config["sql_latency"], meter=meter)
+    engine = FakeEngine(backend)
+    embeddings = FakeEmbeddings(dim=config["embed_dim"], latency=config["embed_latency"], meter=meter)
+    stores: Dict[str, InMemoryVectorStore] = {}
+
+    def get_llm(use_cache: bool = False):
+        return FakeChatModel(latency=config["llm_latency"], token_latency=config["llm_token_latency"],
+                             output_tokens=config["llm_output_tokens"], meter=meter)
+
+    def get_vectorstore(table_name: str):
+        if table_name not in stores:
+            stores[table_name] = InMemoryVectorStore(table_name, embeddings, backend)
+        return stores[table_name]
+
+    def timed(label: str, fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            token = current_node.set(label)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings[label] = (started, time.perf_counter())
+                current_node.reset(token)
+        return run
+
+    patches = [(agent, "get_llm", get_llm), (agent, "get_engine", lambda *a: engine),
+               (agent, "get_vectorstore", get_vectorstore),
+               (vector_search, "get_engine", lambda *a: engine), (vector_search, "get_vectorstore", get_vectorstore),
+               (vector_search, "get_embeddings", lambda: embeddings)]
+    patches += [(agent, fn, timed(label, getattr(agent, fn))) for label, fn in NODES.items()]
+    saved = [(mod, name, getattr(mod, name)) for mod, name, _ in patches]
+    for mod, name, value in patches:
+        setattr(mod, name, value)
+    try:
+        yield get_vectorstore, backend, embeddings
+    finally:
+        for mod, name, value in saved:
+            setattr(mod, name, value)
+
+
+def _load_cohort(cohort: Cohort, get_vectorstore, backend: FakeBackend, embeddings: FakeEmbeddings):
+    # setup is not what is being measured: load the tables with latency off
+    latency = (backend.sql_latency, embeddings.latency)
+    backend.sql_latency = embeddings.latency = 0.0
+    try:
+        get_vectorstore(HOMEWORK_TABLE).add_documents(cohort.homework_docs)
+        get_vectorstore(LESSON_TABLE).add_documents(cohort.lesson_docs)
+    finally:
+        backend.sql_latency, embeddings.latency = latency
+
+
+def _invoke(cohort: Cohort) -> Dict[str, Any]:
+    vector_search._query_vectors.clear()  # every run embeds its queries from scratch
+    graph = agent.build_graph()
+    return graph.invoke({
+        "concepts": cohort.concepts,
+        "students": cohort.students,
+        "homework_vector_table": HOMEWORK_TABLE,
+        "lesson_vector_table": LESSON_TABLE,
+        "bypass_llm_cache": True,
+    })
+
+
+def run_benchmark(config: Optional[Dict[str, Any]] = None, repeat: int = 3, memory: bool = True) -> Dict[str, Any]:
+    """
+    Runs build_graph() `repeat` times on a synthetic cohort with every external service faked.
+    - Per node: median wall time plus llm/embedding/SQL call counts and tokens (identical across repeats).
+    - Peak memory comes from one extra run under tracemalloc, so it does not slow the timed runs.
+    - run["serialized"] lists the OVERLAPS pairs that ran one after the other in any repeat.
+    """
+    config = {**default_config(), **(config or {})}
+    profile = {**PROFILES[config["profile"]], **{k: config[k] for k in ("students", "concepts", "pdfs") if config.get(k)}}
+    config.update(profile)
+    cohort = synthetic_cohort(profile["students"], profile["concepts"], profile["pdfs"], seed=config["seed"])
+
+    meter = Meter()
+    timings: Dict[str, tuple] = {}
+    node_times: Dict[str, List[float]] = {label: [] for label in NODES}
+    serialized = set()
+    totals: List[float] = []
+    counts: Dict[str, Dict[str, int]] = {}
+    with offline(config, meter, timings) as (get_vectorstore, backend, embeddings):
+        _load_cohort(cohort, get_vectorstore, backend, embeddings)
+        for _ in range(max(1, repeat)):
+            meter.reset()
+            timings.clear()
+            started = time.perf_counter()
+            out = _invoke(cohort)
+            totals.append(time.perf_counter() - started)
+            for label in NODES:
+                start, end = timings.get(label, (0.0, 0.0))
+                node_times[label].append(end - start)
+            serialized.update(f"{a} started after {b} finished" for a, b in OVERLAPS.items()
+                              if a in timings and b in timings and timings[a][0] >= timings[b][1])
+            counts = meter.snapshot()
+        peak_mb = None
+        if memory:
+            tracemalloc.start()
+            _invoke(cohort)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+    nodes = {}
+    for label in list(NODES) + sorted(set(counts) - set(NODES)):
+        c = counts.get(label, {})
+        nodes[label] = {"wall_s": round(statistics.median(node_times[label]), 4) if label in node_times else None,
+                        **{m: c.get(m, 0) for m in COUNT_METRICS}}
+    run_counts = {m: sum(c.get(m, 0) for c in counts.values()) for m in COUNT_METRICS}
+    return {
+        "config": config,
+        "environment": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "run": {"wall_s": round(statistics.median(totals), 4), "wall_s_all": [round(t, 4) for t in totals],
+                "peak_mem_mb": round(peak_mb, 2) if peak_mb is not None else None,
+                "weak_lessons": len(out.get("lesson_plans", {})), "serialized": sorted(serialized), **run_counts},
+        "nodes": nodes,
+    }
+
+
+def baseline_path(profile: str) -> str:
+    return os.path.join(BASELINE_DIR, f"{profile}.json")
+
+def save_baseline(result: Dict[str, Any], path: Optional[str] = None) -> str:
+    path = path or baseline_path(result["config"]["profile"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return path
+
+def load_baseline(path: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def overlap_flags(result: Dict[str, Any]) -> List[str]:
+    return [f"overlap: {s}" for s in result["run"].get("serialized", [])]
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2,
+            min_wall_delta: float = 0.05, min_mem_delta: float = 2.0) -> List[str]:
+    """
+    Regressions against a saved baseline.
+    - Call, token and round-trip counts are deterministic: any increase is flagged.
+    - Wall time and peak memory are flagged above (1 + tolerance) x baseline and an absolute floor,
+      to ride out timer noise.
+    - A branch pair in OVERLAPS that ran serialized is always flagged; it needs no baseline.
+    Only notes the config mismatch when the configs differ (the numbers would not be comparable).
+    """
+    keys = [k for k in default_config() if k != "seed"] + ["students", "concepts", "pdfs"]
+    mismatch = [k for k in keys if result["config"].get(k) != baseline["config"].get(k)]
+    if mismatch:
+        return [f"note: config differs from baseline ({', '.join(mismatch)}); comparison skipped"] + overlap_flags(result)
+    flags = overlap_flags(result)
+
+    def check(scope: str, cur: Dict[str, Any], base: Dict[str, Any]):
+        for m in COUNT_METRICS:
+            if cur.get(m, 0) > base.get(m, 0):
+                flags.append(f"{scope}.{m}: {base.get(m, 0)} -> {cur.get(m, 0)}")
+        for m, floor in (("wall_s", min_wall_delta), ("peak_mem_mb", min_mem_delta)):
+            b, c = base.get(m), cur.get(m)
+            if b is not None and c is not None and c > b * (1 + tolerance) and c - b > floor:
+                flags.append(f"{scope}.{m}: {b} -> {round(c, 4)} (+{(c / b - 1) * 100 if b else float('inf'):.0f}%)")
+
+    check("run", result["run"], baseline["run"])
+    for label, cur in result["nodes"].items():
+        check(label, cur, baseline["nodes"].get(label, {}))
+    return flags
+
+
+def format_report(result: Dict[str, Any]) -> str:
+    cols = ("wall_s",) + COUNT_METRICS
+    lines = [f"profile={result['config']['profile']} students={result['config']['students']} "
+             f"concepts={result['config']['concepts']} pdfs={result['config']['pdfs']}",
+             f"{'node':<16}" + "".join(f"{c:>16}" for c in cols)]
+    for label, row in result["nodes"].items():
+        lines.append(f"{label:<16}" + "".join(f"{'-' if row.get(c) is None else row[c]:>16}" for c in cols))
+    run = result["run"]
+    lines.append(f"{'run':<16}" + "".join(f"{run.get(c, '-'):>16}" for c in cols))
+    lines.append(f"peak memory: {run['peak_mem_mb']} MB   wall per repeat: {run['wall_s_all']}")
+    lines += [f"serialized: {s}" for s in run.get("serialized", [])]
+    return "\n".join(lines)
@@ -5,6 +5,7 @@ import time
 #import uuid
 import math
 from typing import TypedDict, List, Dict, Any, Optional
+import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -15,6 +16,7 @@ from tooling.tidb import *
 from tooling.vector_search import *
 #from tooling.agent_capabilities import *
 from agent import *
+from tooling.instrumentation import trace_run
 
 
 load_dotenv()
@@ -22,14 +24,94 @@ os.environ["OPENAI_API_KEY"] =os.getenv('OPENAI_API_KEY')
 
 
 st.set_page_config(page_title="LangGraph + TiDB Classroom Evaluator", layout="wide")
+
+RESULTS_CACHE_TTL = int(os.getenv("RESULTS_CACHE_TTL", "60"))  # seconds; batch runs in other processes write too
+RESULT_KEYS = ("scores", "pain_points", "reports", "groups", "lesson_plans", "homework")
+TREND_RUNS = int(os.getenv("TREND_RUNS", "30"))  # runs shown in the concept trend chart
+
+@st.cache_resource(show_spinner=False)
+def _engine() -> Engine:
+    # once per server process, not on every rerun
+    engine = get_engine()
+    ensure_relational_schema(engine)
+    return engine
+
+@st.cache_data(ttl=RESULTS_CACHE_TTL, max_entries=32, show_spinner=False)
+def _saved_results(students: tuple, concepts: tuple) -> Dict[str, Any]:
+    out = load_latest_results(_engine(), list(students), list(concepts))
+    if isinstance(out["scores"], ScoreMatrix):
+        out["scores"] = out["scores"].to_dict()
+    return out
+
+@st.cache_data(ttl=RESULTS_CACHE_TTL, max_entries=32, show_spinner=False)
+def _concept_trends(concepts: tuple, last_runs: int) -> Dict[str, List[Dict[str, Any]]]:
+    return concept_trends(_engine(), list(concepts), last_runs=last_runs)
+
+def _load_saved_results(students: List[str], concepts: List[str]):
+    # a new session (or a changed class) starts from what TiDB already holds instead of an empty page
+    key = (tuple(students), tuple(concepts))
+    if st.session_state.get("results_for") == key:
+        return
+    saved = _saved_results(*key)
+    for k in RESULT_KEYS:
+        st.session_state[k] = saved.get(k, {})
+    st.session_state["results_for"] = key
+    st.session_state["results_saved"] = bool(saved.get("scores"))
+
+def _ingest_progress():
+    bar = st.progress(0.0)
+    def update(stats):
+        finished = stats["files_done"] + stats["files_skipped"] + len(stats["errors"])
+        bar.progress(min(finished / max(stats["files"], 1), 1.0),
+                     text=f"{finished}/{stats['files']} files · {stats['chunks_inserted']} chunks · "
+                          f"{stats['chunks_per_s']:.1f} chunks/s")
+    return update
+
+LIVE_TITLES = {"reports": "Report: {}", "lessons": "Lesson: {}", "homework": "Homework: {}"}
+LIVE_REFRESH_S = 0.1  # per-expander redraw interval while tokens arrive
+
+def _live_output(container):
+    # one expander per report / lesson plan / homework, filled in as its tokens stream
+    panes: Dict[tuple, Any] = {}
+    texts: Dict[tuple, str] = {}
+    drawn: Dict[tuple, float] = {}
+    def on_token(event):
+        key = (event["node"], event["key"])
+        if key not in panes:
+            title = LIVE_TITLES.get(event["node"], "{}").format(event["key"])
+            panes[key] = container.expander(title, expanded=len(panes) < 3).empty()
+        if event.get("done"):
+            panes[key].markdown(event["text"])
+            return
+        texts[key] = texts.get(key, "") + event["delta"]
+        now = time.monotonic()
+        if now - drawn.get(key, 0.0) >= LIVE_REFRESH_S:
+            panes[key].markdown(texts[key] + " ▌")
+            drawn[key] = now
+    return on_token
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _knowledge_graph_png(fingerprint: str, _scores, concepts: tuple, aware_threshold: float) -> bytes:
+    # keyed on the score matrix hash (underscored args are not hashed), so reruns just re-send the PNG
+    return render_knowledge_graph(_scores, list(concepts), aware_threshold=aware_threshold)
+
+def _render_breakdown(container, summary: Dict[str, Any]):
+    # where the run's time went: one row per instrumented span name, slowest total first
+    c = summary["counters"]
+    rows = sorted(({"span": name, **row} for name, row in summary["spans"].items()), key=lambda r: -r["total_s"])
+    with container.container():
+        st.caption(f"{summary['wall_s']:.1f}s · {int(c.get('llm.calls', 0))} LLM calls · "
+                   f"{int(c.get('llm.input_tokens', 0))} input / {int(c.get('llm.output_tokens', 0))} output tokens · "
+                   f"{int(c.get('sql.round_trips', 0))} SQL round trips")
+        st.dataframe(rows, use_container_width=True, hide_index=True)
+
 def main():
     st.title("📘Comprende: LangGraph + TiDB Comprehension Evaluator")
     homework_table = os.getenv("VECTOR_TABLE", "homework_vector")
     lesson_table = os.getenv("LESSON_VECTOR_TABLE", "lesson_vector")
 
-    # Ensure relational schema
-    engine = get_engine()
-    ensure_relational_schema(engine)
+    # Ensure relational schema (cached for the process)
+    _engine()
 
     st.sidebar.header("Setup")
     student_names_str = st.sidebar.text_area("Student names (comma-separated)", "Aarav,Bhavana,Chitra,Dev")
@@ -40,6 +122,13 @@ def main():
     st.sidebar.subheader("Vector Tables")
     st.sidebar.text_input("Homework vector table", homework_table, key="hw_table")
     st.sidebar.text_input("Lesson vector table", lesson_table, key="lsn_table")
+    st.sidebar.checkbox("Bypass LLM response cache", value=False, key="bypass_llm_cache")
+    if st.sidebar.button("Reload saved results"):
+        _saved_results.clear()
+        _concept_trends.clear()
+        st.session_state.pop("results_for", None)
+    with st.sidebar.expander("Connection pools", expanded=False):
+        st.json(pool_stats())
 
     col1, col2 = st.columns(2)
 
@@ -53,12 +142,11 @@ def main():
                 st.error("Please upload at least one PDF and select a student.")
             else:
                 vs = get_vectorstore(st.session_state.get("hw_table", homework_table))
-                all_docs = []
-                for f in uploaded_homework:
-                    docs = load_pdfs_to_docs(f, selected_student)
-                    all_docs.extend(docs)
-                ingest_documents(all_docs, vs)
-                st.success(f"Ingested {len(all_docs)} chunks for {selected_student} into TiDB Vector.")
+                stats = stream_ingest(uploaded_homework, selected_student, vs, on_progress=_ingest_progress())
+                for name, err in stats["errors"]:
+                    st.warning(f"Skipped {name}: {err}")
+                st.success(f"Ingested {stats['chunks_inserted']} new chunks for {selected_student} into TiDB Vector "
+                           f"({stats['files_skipped']} unchanged files, {stats['chunks_skipped']} chunks skipped).")
 
     with col2:
         st.header("2) Ingest lesson/reference PDFs → TiDB Vector")
@@ -69,42 +157,80 @@ def main():
                 st.error("Please upload at least one PDF.")
             else:
                 vs = get_vectorstore(st.session_state.get("lsn_table", lesson_table))
-                all_docs = []
-                for f in uploaded_lessons:
-                    # For lesson docs, we keep student_name = 'LESSON'
-                    docs = load_pdfs_to_docs(f, student_name="LESSON")
-                    all_docs.extend(docs)
-                ingest_documents(all_docs, vs)
-                st.success(f"Ingested {len(all_docs)} lesson chunks into TiDB Vector.")
+                # For lesson docs, we keep student_name = 'LESSON'
+                stats = stream_ingest(uploaded_lessons, "LESSON", vs, on_progress=_ingest_progress())
+                for name, err in stats["errors"]:
+                    st.warning(f"Skipped {name}: {err}")
+                st.success(f"Ingested {stats['chunks_inserted']} new lesson chunks into TiDB Vector "
+                           f"({stats['files_skipped']} unchanged files, {stats['chunks_skipped']} chunks skipped).")
 
     st.markdown("---")
 
     st.header("3) Run end-to-end agent (LangGraph)")
-    st.caption("Runs: evaluate → report → knowledge graph + groups → lesson plans → personalized homework")
+    st.caption("Runs: evaluate → (reports ∥ knowledge graph + groups ∥ lesson plans ∥ personalized homework)")
+    incremental = st.checkbox("Incremental: re-grade only students/concepts whose homework changed", value=True)
+    stream_output = st.checkbox("Stream reports, lesson plans and homework as they are written", value=True)
     if st.button("Run full pipeline now"):
-        graph = build_graph()
         init: PipelineState = {
             "concepts": concepts,
             "students": student_names,
             "homework_vector_table": st.session_state.get("hw_table", homework_table),
             "lesson_vector_table": st.session_state.get("lsn_table", lesson_table),
+            "bypass_llm_cache": st.session_state.get("bypass_llm_cache", False),
+            "incremental": incremental,
         }
-        with st.status("Running agent… This can take a few minutes depending on PDFs & model.", expanded=True):
-            out = graph.invoke(init)
+        pending = pending_nodes(init)
+        if pending:
+            st.info(f"Resuming the interrupted run at: {', '.join(pending)}")
+        cache_before = llm_cache_stats()
+        panel = st.empty()
+        live = st.empty()  # streamed drafts; cleared once the results below are rendered
+        with trace_run("pipeline", {"ui.students": len(student_names), "ui.concepts": len(concepts)}) as trace:
+            def refresh(_update):
+                if trace is not None:
+                    _render_breakdown(panel, trace.summary())
+            def progress(event):
+                if event.get("student"):
+                    st.write(f"Evaluating **{event['student']}** …")
+                else:
+                    st.write(event["message"])
+            with st.status("Running agent… This can take a few minutes depending on PDFs & model.", expanded=True):
+                out = run_pipeline(init, on_step=refresh, progress=progress,
+                                   on_token=_live_output(live.container()) if stream_output else None)
+        panel.empty()
+        live.empty()
+        if trace is not None:
+            st.session_state["trace_summary"] = trace.summary()
+            st.session_state["trace_file"] = trace.attributes.get("trace_file")
+        cache_after = llm_cache_stats()
         st.success("Agent run completed.")
+        st.caption(f"LLM cache: {cache_after['hits'] - cache_before['hits']} hits, "
+                   f"{cache_after['misses'] - cache_before['misses']} misses ({cache_after['entries']} entries on disk)")
 
-        # Cache to session
-        st.session_state["scores"] = out.get("scores", {})
-        st.session_state["pain_points"] = out.get("pain_points", {})
-        st.session_state["reports"] = out.get("reports", {})
-        st.session_state["groups"] = out.get("groups", {})
-        st.session_state["lesson_plans"] = out.get("lesson_plans", {})
-        st.session_state["homework"] = out.get("homework", {})
+        # Cache to session; other sessions pick the new rows up from TiDB
+        for k in RESULT_KEYS:
+            st.session_state[k] = out.get(k, {})
+        st.session_state["results_for"] = (tuple(student_names), tuple(concepts))
+        st.session_state["results_saved"] = False
+        _saved_results.clear()
+        _concept_trends.clear()
 
     st.markdown("---")
     st.header("4) Results & Visuals")
+    _load_saved_results(student_names, concepts)
+    if st.session_state.get("results_saved"):
+        st.caption("Showing the latest saved results for these students and concepts. Run the pipeline to refresh them.")
 
 
+    if st.session_state.get("trace_summary"):
+        st.subheader("Run breakdown")
+        _render_breakdown(st.empty(), st.session_state["trace_summary"])
+        trace_file = st.session_state.get("trace_file")
+        if trace_file and os.path.exists(trace_file):
+            with open(trace_file, "rb") as f:
+                st.download_button("Download trace (JSON)", f.read(), file_name=os.path.basename(trace_file),
+                                   mime="application/json")
+
     if "reports" in st.session_state and st.session_state["reports"]:
         st.subheader("Per-student reports")
         for s, md in st.session_state["reports"].items():
@@ -113,8 +239,15 @@ def main():
 
     if "scores" in st.session_state and st.session_state["scores"]:
         st.subheader("Knowledge graph (students ↔ concepts they are aware of)")
-        fig = plot_knowledge_graph(st.session_state["scores"], concepts, aware_threshold=70)
-        st.pyplot(fig)
+        scores = ScoreMatrix.from_dict(st.session_state["scores"], concepts)
+        st.image(_knowledge_graph_png(scores.fingerprint(), scores, tuple(concepts), 70.0))
+
+    trends = _concept_trends(tuple(concepts), TREND_RUNS)
+    if any(len(points) > 1 for points in trends.values()):
+        st.subheader("Class average per concept, by run")
+        st.line_chart(pd.DataFrame([{"run": p["at"], "concept": c, "average": p["mean"]}
+                                    for c, points in trends.items() for p in points]),
+                      x="run", y="average", color="concept")
 
     if "groups" in st.session_state and st.session_state["groups"]:
         st.subheader("Study groups")
@@ -0,0 +1,4 @@
+import os
+
+# tooling modules copy OPENAI_API_KEY into os.environ at import time; no test talks to OpenAI
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
@@ -0,0 +1,24 @@
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from tooling.cache import SQLiteLLMCache, stream_with_cache
+
+
+def _prompt(text):
+    return [SystemMessage(content="sys"), HumanMessage(content=text)]
+
+def test_stream_shares_cache_entries_with_invoke(tmp_path):
+    cache = SQLiteLLMCache(str(tmp_path / "llm.sqlite"))
+    replies = iter([AIMessage(content="alpha beta"), AIMessage(content="one two three")])
+    llm = GenericFakeChatModel(messages=replies, cache=cache)
+
+    assert llm.invoke(_prompt("a")).content == "alpha beta"
+    assert list(stream_with_cache(llm, _prompt("a"))) == ["alpha beta"]  # hit written by invoke, one delta
+
+    assert "".join(stream_with_cache(llm, _prompt("b"))) == "one two three"  # miss: streamed, then stored
+    assert llm.invoke(_prompt("b")).content == "one two three"
+    assert cache.stats()["hits"] == 2
+
+def test_stream_without_cache_streams():
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="x y")]), cache=False)
+    assert list(stream_with_cache(llm, _prompt("a"))) == ["x", " ", "y"]
@@ -0,0 +1,96 @@
+import itertools
+import random
+
+from tooling.agent_capabilities import _exact_groups, _group_sizes, build_study_groups
+
+
+def _coverage(masks, groups):
+    total = 0
+    for group in groups:
+        cov = 0
+        for i in group:
+            cov |= masks[i]
+        total += bin(cov).count("1")
+    return total
+
+def _brute_force(masks, sizes):
+    best = -1
+    for order in itertools.permutations(range(len(masks))):
+        groups, start = [], 0
+        for size in sizes:
+            groups.append(order[start:start + size])
+            start += size
+        best = max(best, _coverage(masks, groups))
+    return best
+
+def _set_based_groups(scores, concepts, target_size, ties="set"):
+    # build_study_groups before the bitset rewrite; ties="input" breaks its max() ties by input order
+    aware = {c: {s for s, m in scores.items() if m.get(c, 0) >= 70.0} for c in concepts}
+    unassigned = set(scores) if ties == "set" else list(scores)
+    coverage = lambda group: {c for c in concepts if aware[c] & group}
+    groups = []
+    while unassigned:
+        best = max(unassigned, key=lambda s: sum(1 for c in concepts if s in aware[c]))
+        group = {best}
+        unassigned.remove(best)
+        covered = coverage(group)
+        while len(group) < target_size and unassigned:
+            pick = max(unassigned, key=lambda s: len(coverage(group | {s}) - covered))
+            group.add(pick)
+            unassigned.remove(pick)
+            covered = coverage(group)
+        groups.append(sorted(group))
+    return groups
+
+def _random_class(rng, max_students):
+    concepts = [f"c{j}" for j in range(rng.randint(1, 8))]
+    scores = {f"s{i}": {c: rng.choice([0, 50, 80, 95]) for c in concepts} for i in range(rng.randint(1, max_students))}
+    return scores, concepts
+
+def _score_coverage(scores, concepts, groups):
+    return sum(sum(any(scores[s].get(c, 0) >= 70 for s in g) for c in concepts) for g in groups)
+
+def _check(masks, sizes):
+    groups = _exact_groups(masks, sizes)
+    assert sorted(i for g in groups for i in g) == list(range(len(masks)))
+    assert sorted(map(len, groups)) == sorted(sizes)
+    assert _coverage(masks, groups) == _brute_force(masks, sizes)
+
+
+def test_head_student_can_land_in_a_smaller_group():
+    _check([11, 13, 12, 0, 3], [2, 2, 1])
+
+def test_matches_brute_force_on_small_classes():
+    rng = random.Random(13)
+    for n in range(1, 9):
+        for target in (2, 3, 4):
+            for balanced in (False, True):
+                masks = [rng.getrandbits(5) for _ in range(n)]
+                _check(masks, _group_sizes(n, target, balanced))
+
+def test_matches_brute_force_on_mixed_sizes():
+    rng = random.Random(7)
+    for _ in range(40):
+        n = rng.randint(2, 8)
+        sizes = []
+        while sum(sizes) < n:
+            sizes.append(rng.randint(1, n - sum(sizes)))
+        _check([rng.getrandbits(6) for _ in range(n)], sizes)
+
+def test_greedy_matches_set_based_reference_pick_for_pick():
+    rng = random.Random(500)
+    for _ in range(500):
+        scores, concepts = _random_class(rng, 12)
+        target = rng.randint(2, 4)
+        groups = list(build_study_groups(scores, concepts, target).values())
+        assert groups == _set_based_groups(scores, concepts, target, ties="input")
+
+def test_greedy_and_set_based_reference_never_beat_exact():
+    rng = random.Random(18)
+    for _ in range(300):
+        scores, concepts = _random_class(rng, 8)
+        target = rng.randint(2, 4)
+        exact = _score_coverage(scores, concepts, build_study_groups(scores, concepts, target, method="exact").values())
+        greedy = _score_coverage(scores, concepts, build_study_groups(scores, concepts, target).values())
+        reference = _score_coverage(scores, concepts, _set_based_groups(scores, concepts, target))
+        assert greedy <= exact and reference <= exact
@@ -1,10 +1,18 @@
 
 import networkx as nx
 import matplotlib.pyplot as plt
+import numpy as np
+import itertools
+from .score_matrix import ScoreMatrix
+from .instrumentation import traced
 from dotenv import load_dotenv
 import os
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from typing import TypedDict, List, Dict, Any, Optional
+from typing import TypedDict, List, Dict, Any, Optional, Tuple
+from openai import RateLimitError
+import asyncio
+import contextlib
+import random
 import json
 
 load_dotenv()
@@ -27,11 +35,12 @@ Instructions:
 - Output JSON ONLY, no markdown.
 """
 
-def score_comprehension(llm: ChatOpenAI, student_name: str, concept: str, snippets: List[str]) -> Dict[str, Any]:
+def _scorer_messages(student_name: str, concept: str, snippets: List[str]):
     from langchain_core.messages import SystemMessage, HumanMessage
     user = USER_SCORER.format(concept=concept, student_name=student_name, snippets="\n\n---\n\n".join(snippets))
-    msgs = [SystemMessage(content=SYSTEM_SCORER), HumanMessage(content=user)]
-    resp = llm.invoke(msgs).content
+    return [SystemMessage(content=SYSTEM_SCORER), HumanMessage(content=user)]
+
+def _parse_grader_output(resp: str) -> Dict[str, Any]:
     try:
         data = json.loads(resp)
     except Exception:
@@ -46,6 +55,118 @@ def score_comprehension(llm: ChatOpenAI, student_name: str, concept: str, snippe
     data.setdefault("evidence", [])
     return data
 
+@traced("llm.score_comprehension")
+def score_comprehension(llm: ChatOpenAI, student_name: str, concept: str, snippets: List[str]) -> Dict[str, Any]:
+    msgs = _scorer_messages(student_name, concept, snippets)
+    resp = llm.invoke(msgs).content
+    return _parse_grader_output(resp)
+
+async def ainvoke_with_backoff(llm: ChatOpenAI, msgs, retries: int = 5, base_delay: float = 1.0):
+    """
+    ainvoke with exponential backoff (plus jitter) on rate-limit errors; anything else is raised as-is.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await llm.ainvoke(msgs)
+        except RateLimitError:
+            if attempt >= retries:
+                raise
+            await asyncio.sleep(base_delay * (2 ** attempt) + random.uniform(0, base_delay))
+
+@traced("llm.score_comprehension")
+async def ascore_comprehension(llm: ChatOpenAI, student_name: str, concept: str, snippets: List[str]) -> Dict[str, Any]:
+    msgs = _scorer_messages(student_name, concept, snippets)
+    resp = (await ainvoke_with_backoff(llm, msgs)).content
+    return _parse_grader_output(resp)
+
+SYSTEM_SCORER_BATCH = """You are a strict but fair grader. You will read the student's submission snippets and assess their comprehension of each target concept independently.
+Return concise JSON: one object keyed by the exact concept names given, where each value has keys: score (0-100), pain_points (array of short strings), evidence (array of short quotes).
+Score rubric:
+- 90-100: Mastery (precise, transferable, correct terminology)
+- 70-89: Proficient (mostly correct, minor gaps)
+- 50-69: Developing (partial understanding, notable gaps)
+- 0-49: Beginning (confused, misconceptions or missing)
+"""
+USER_SCORER_BATCH = """Target Concepts: {concepts_json}
+Student: {student_name}
+Relevant snippets (numbered, deduplicated; not verbatim full text, only selected chunks):
+{snippets}
+Snippets retrieved for each concept:
+{concept_index}
+Instructions:
+- Grade every concept listed, using mainly the snippets retrieved for it and general knowledge of the concept (avoid hallucinations).
+- Output JSON ONLY, no markdown.
+"""
+
+def _batch_scorer_messages(student_name: str, concept_snippets: Dict[str, List[str]]):
+    from langchain_core.messages import SystemMessage, HumanMessage
+    unique: List[str] = []
+    pos: Dict[str, int] = {}
+    index_lines = []
+    for concept, snippets in concept_snippets.items():
+        refs = []
+        for sn in snippets:
+            if sn not in pos:
+                pos[sn] = len(unique)
+                unique.append(sn)
+            refs.append(f"#{pos[sn] + 1}")
+        index_lines.append(f"- {json.dumps(concept)}: {', '.join(refs) or '(none)'}")
+    user = USER_SCORER_BATCH.format(
+        concepts_json=json.dumps(list(concept_snippets)),
+        student_name=student_name,
+        snippets="\n\n---\n\n".join(f"#{i + 1} {sn}" for i, sn in enumerate(unique)),
+        concept_index="\n".join(index_lines),
+    )
+    return [SystemMessage(content=SYSTEM_SCORER_BATCH), HumanMessage(content=user)]
+
+def _parse_batch_output(resp: str, concepts: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Returns only the concepts that came back well-formed; callers re-grade the rest one by one.
+    """
+    try:
+        data = json.loads(resp)
+    except Exception:
+        start = resp.find("{")
+        end = resp.rfind("}")
+        try:
+            data = json.loads(resp[start:end+1]) if start >= 0 and end > start else {}
+        except Exception:
+            data = {}
+    if not isinstance(data, dict):
+        return {}
+    by_lower = {str(k).strip().lower(): v for k, v in data.items()}
+    out: Dict[str, Dict[str, Any]] = {}
+    for c in concepts:
+        v = data.get(c, by_lower.get(c.strip().lower()))
+        if not isinstance(v, dict) or "score" not in v:
+            continue
+        try:
+            float(v["score"])
+        except (TypeError, ValueError):
+            continue
+        v.setdefault("pain_points", [])
+        v.setdefault("evidence", [])
+        out[c] = v
+    return out
+
+@traced("llm.score_comprehension_batch")
+async def ascore_comprehension_batch(llm: ChatOpenAI, student_name: str, concept_snippets: Dict[str, List[str]],
+                                     sem: Optional[asyncio.Semaphore] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Grades all of a student's concepts in one call; concepts missing from the reply fall back to ascore_comprehension.
+    - sem: the caller's concurrency limit; the batch call and every fallback call each take their own slot.
+    """
+    limit = sem or contextlib.nullcontext()
+    async with limit:
+        resp = (await ainvoke_with_backoff(llm, _batch_scorer_messages(student_name, concept_snippets))).content
+    results = _parse_batch_output(resp, list(concept_snippets))
+    async def retry(c: str):
+        async with limit:
+            return await ascore_comprehension(llm, student_name, c, concept_snippets[c])
+    missing = [c for c in concept_snippets if c not in results]
+    results.update(zip(missing, await asyncio.gather(*(retry(c) for c in missing))))
+    return {c: results[c] for c in concept_snippets}
+
 SYSTEM_REPORT = """You are a teaching assistant generating a brief, actionable student report based on comprehension scores per concept.
 Return markdown structured with: Summary, Strengths (bullets), Pain Points (bullets), Recommended Next Steps (bullets)."""
 USER_REPORT = """Student: {student_name}
@@ -70,55 +191,180 @@ Use the lesson context (snippets) to shape tasks:
 {context}
 """
 
-def build_study_groups(scores: Dict[str, Dict[str, float]], concepts: List[str], target_size: int = 2) -> Dict[int, List[str]]:
+EXACT_GROUPING_MAX_STUDENTS = 12
+
+def _awareness_matrix(scores: Dict[str, Dict[str, float]], concepts: List[str], threshold: float) -> np.ndarray:
+    if isinstance(scores, ScoreMatrix):
+        return scores.columns(concepts, fill=0.0) >= threshold
+    return np.array([[m.get(c, 0) >= threshold for c in concepts] for m in scores.values()], dtype=bool).reshape(len(scores), len(concepts))
+
+def _pack_bits(aware: np.ndarray) -> np.ndarray:
+    """
+    (S, C) bool -> (S, W) uint64 bitsets, W = ceil(C / 64).
+    """
+    words = max(1, -(-aware.shape[1] // 64))
+    padded = np.zeros((aware.shape[0], words * 64), dtype=bool)
+    padded[:, :aware.shape[1]] = aware
+    return np.packbits(padded, axis=1, bitorder="little").view(np.uint64)
+
+def _group_sizes(n: int, target_size: int, balanced: bool) -> List[int]:
+    target_size = max(1, target_size)
+    if not balanced:
+        return [min(target_size, n - i) for i in range(0, n, target_size)]
+    groups = -(-n // target_size)
+    return [n // groups + (1 if i < n % groups else 0) for i in range(groups)]
+
+def _greedy_groups(bits: np.ndarray, counts: np.ndarray, sizes: List[int]) -> List[List[int]]:
+    alive = np.ones(bits.shape[0], dtype=bool)
+    by_count = np.argsort(-counts, kind="stable")  # first pick: most concepts known, ties -> input order
+    cursor = 0
+    # candidate pool for marginal picks; compacted whenever half of it has been assigned
+    idx = np.arange(bits.shape[0])
+    cand = bits
+    live = np.ones(len(idx), dtype=bool)
+    n_live = len(idx)
+    groups = []
+    for size in sizes:
+        while not alive[by_count[cursor]]:
+            cursor += 1
+        first = int(by_count[cursor])
+        group = [first]
+        covered = bits[first].copy()
+        alive[first] = False
+        live[np.searchsorted(idx, first)] = False
+        n_live -= 1
+        while len(group) < size:
+            if n_live * 2 < len(idx):
+                idx, cand = idx[live], cand[live]
+                live = np.ones(len(idx), dtype=bool)
+            gain = np.bitwise_count(cand & ~covered).sum(axis=1, dtype=np.int32)
+            pos = int(np.argmax((gain + 1) * live))  # assigned rows score 0; ties -> input order
+            pick = int(idx[pos])
+            live[pos] = False
+            n_live -= 1
+            alive[pick] = False
+            group.append(pick)
+            covered |= bits[pick]
+        groups.append(group)
+    return groups
+
+def _exact_groups(masks: List[int], sizes: List[int]) -> List[List[int]]:
+    """
+    Exhaustive search over partitions into the given sizes, maximising total concepts covered summed over
+    groups (small classes only).
+    - The first unassigned student opens a group of each distinct size still open, so every partition is
+      scored exactly once.
+    """
+    best: Dict[str, Any] = {"score": -1, "groups": None}
+    def search(remaining: List[int], open_sizes: Tuple[int, ...], acc: List[List[int]], score: int):
+        if not remaining:
+            if score > best["score"]:
+                best["score"], best["groups"] = score, [list(g) for g in acc]
+            return
+        head, rest = remaining[0], remaining[1:]
+        for k, size in enumerate(open_sizes):
+            if size in open_sizes[:k]:
+                continue  # same size as a slot already tried for this head
+            left_sizes = open_sizes[:k] + open_sizes[k + 1:]
+            for mates in itertools.combinations(rest, size - 1):
+                group = (head,) + mates
+                cov = 0
+                for i in group:
+                    cov |= masks[i]
+                left = [i for i in rest if i not in mates]
+                search(left, left_sizes, acc + [list(group)], score + bin(cov).count("1"))
+    search(list(range(len(masks))), tuple(sorted(sizes, reverse=True)), [], 0)
+    return best["groups"] or []
+
+def build_study_groups(scores: Dict[str, Dict[str, float]], concepts: List[str], target_size: int = 2,
+                       balanced: bool = False, method: str = "greedy", aware_threshold: float = 70.0) -> Dict[int, List[str]]:
     """
     Greedy heuristic:
     - While unassigned students exist, build a group by covering all concepts:
       pick student covering most uncovered concepts, then add complementary students.
     - Fill remaining slots with students that maximize marginal coverage.
+    Awareness is packed into uint64 bitsets, so each pick is one vectorized popcount over the unassigned
+    students; ties go to the earlier student in `scores`. Picks match the former set-based version when its
+    ties are broken the same way; with its set-order ties, coverage can differ either way, never above exact.
+    balanced=True spreads students so group sizes differ by at most one (instead of a short last group).
+    method="exact" searches all partitions for classes of up to EXACT_GROUPING_MAX_STUDENTS students.
     """
-    aware = {c: {s for s, m in scores.items() if m.get(c, 0) >= 70.0} for c in concepts}
-    all_students = set(scores.keys())
-    unassigned = set(all_students)
-    groups: Dict[int, List[str]] = {}
-    gid = 1
-    def coverage(group: set) -> set:
-        covered = set()
-        for c in concepts:
-            if len(aware[c].intersection(group)) > 0:
-                covered.add(c)
-        return covered
-    while unassigned:
-        group = set()
-        covered = set()
-        best = max(unassigned, key=lambda s: sum(1 for c in concepts if s in aware[c]), default=None)
-        if best:
-            group.add(best); unassigned.remove(best)
-            covered = coverage(group)
-        while (covered != set(concepts)) and len(group) < target_size and unassigned:
-            pick = max(unassigned, key=lambda s: len(coverage(group | {s}) - covered))
-            group.add(pick); unassigned.remove(pick)
-            covered = coverage(group)
-        while len(group) < target_size and unassigned:
-            pick = max(unassigned, key=lambda s: len(coverage(group | {s}) - covered))
-            group.add(pick); unassigned.remove(pick)
-            covered = coverage(group)
-        groups[gid] = sorted(group)
-        gid += 1
-    return groups
+    students = list(scores.keys())
+    if not students:
+        return {}
+    aware = _awareness_matrix(scores, concepts, aware_threshold)
+    sizes = _group_sizes(len(students), target_size, balanced)
+    if method == "exact" and len(students) <= EXACT_GROUPING_MAX_STUDENTS:
+        masks = [sum(1 << j for j in np.flatnonzero(row)) for row in aware]
+        picked = _exact_groups(masks, sizes)
+    else:
+        picked = _greedy_groups(_pack_bits(aware), aware.sum(axis=1), sizes)
+    return {gid: sorted(students[i] for i in members) for gid, members in enumerate(picked, start=1)}
+
+KG_HEATMAP_MIN_NODES = int(os.getenv("KG_HEATMAP_MIN_NODES", "120"))  # students + concepts
+KG_HEATMAP_MAX_ROWS = int(os.getenv("KG_HEATMAP_MAX_ROWS", "40"))
+
+def _bipartite_layout(students: List[str], concepts: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Students in a left column, concepts in a right column, both in input order.
+    - Deterministic and O(n), unlike spring_layout, so the same scores always draw the same picture.
+    """
+    def column(names, x):
+        ys = np.linspace(1.0, 0.0, len(names)) if len(names) > 1 else np.array([0.5])
+        return {n: np.array([x, y]) for n, y in zip(names, ys)}
+    return {**column(students, 0.0), **column(concepts, 1.0)}
 
 def plot_knowledge_graph(scores: Dict[str, Dict[str, float]], concepts: List[str], aware_threshold: float = 70.0) -> plt.Figure:
+    sm = ScoreMatrix.from_dict(scores, concepts)
     G = nx.Graph()
-    for s in scores:
+    for s in sm.students:
         G.add_node(s, bipartite=0, color="#3b82f6")  # students
     for c in concepts:
         G.add_node(c, bipartite=1, color="#10b981")  # concepts
-    for s, m in scores.items():
-        for c, v in m.items():
-            if v >= aware_threshold:
-                G.add_edge(s, c, weight=1.0)
-    pos = nx.spring_layout(G, seed=42, k=0.7)
+    for i, j in np.argwhere(sm.columns(concepts) >= aware_threshold):
+        G.add_edge(sm.students[i], concepts[j], weight=1.0)
+    pos = _bipartite_layout(sm.students, concepts)
     colors = [G.nodes[n].get("color", "#999999") for n in G.nodes()]
-    fig = plt.figure(figsize=(8, 6))
+    fig = plt.figure(figsize=(8, max(6, 0.25 * max(len(sm.students), len(concepts)))))
     nx.draw(G, pos, with_labels=True, node_color=colors, node_size=800, font_size=8, edge_color="#7e2222")
     return fig
+
+def plot_knowledge_heatmap(scores: Dict[str, Dict[str, float]], concepts: List[str], aware_threshold: float = 70.0,
+                           max_rows: int = KG_HEATMAP_MAX_ROWS) -> plt.Figure:
+    """
+    Aggregated view for large classes: share of students aware of each concept, per cluster.
+    - Students are ordered by their awareness pattern (identical patterns end up adjacent),
+      then cut into at most max_rows equal clusters.
+    """
+    sm = ScoreMatrix.from_dict(scores, concepts)
+    aware = sm.columns(concepts, fill=0.0) >= aware_threshold
+    order = np.lexsort(aware.T[::-1]) if aware.size else np.arange(len(sm.students))
+    clusters = [c for c in np.array_split(order, min(max_rows, len(order)) or 1) if len(c)]
+    share = np.array([aware[c].mean(axis=0) for c in clusters]) if clusters else np.zeros((0, len(concepts)))
+    fig, ax = plt.subplots(figsize=(max(8, 0.35 * len(concepts)), max(4, 0.3 * len(clusters))))
+    im = ax.imshow(share, aspect="auto", cmap="Greens", vmin=0.0, vmax=1.0, interpolation="nearest")
+    ax.set_xticks(range(len(concepts)))
+    ax.set_xticklabels(concepts, rotation=60, ha="right", fontsize=7)
+    ax.set_yticks(range(len(clusters)))
+    ax.set_yticklabels([sm.students[c[0]] if len(c) == 1 else f"{len(c)} students" for c in clusters], fontsize=7)
+    ax.set_title(f"Share of students aware (score >= {aware_threshold:g}), {len(sm.students)} students")
+    fig.colorbar(im, ax=ax, fraction=0.03)
+    fig.tight_layout()
+    return fig
+
+def render_knowledge_graph(scores: Dict[str, Dict[str, float]], concepts: List[str], aware_threshold: float = 70.0,
+                           mode: str = "auto") -> bytes:
+    """
+    PNG bytes of the knowledge graph; mode="auto" switches to the heatmap above KG_HEATMAP_MIN_NODES nodes.
+    - Returns bytes (and closes the figure) so callers can cache the result keyed on ScoreMatrix.fingerprint().
+    """
+    import io
+    sm = ScoreMatrix.from_dict(scores, concepts)
+    if mode == "auto":
+        mode = "heatmap" if len(sm.students) + len(concepts) >= KG_HEATMAP_MIN_NODES else "graph"
+    plot = plot_knowledge_heatmap if mode == "heatmap" else plot_knowledge_graph
+    fig = plot(sm, concepts, aware_threshold=aware_threshold)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=110)
+    plt.close(fig)
+    return buf.getvalue()
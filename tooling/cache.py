@@ -0,0 +1,193 @@
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+from langchain_core.messages import convert_to_messages, message_chunk_to_message
+from langchain_core.outputs import ChatGeneration
+from langchain_core.stores import ByteStore
+from typing import TypedDict, List, Dict, Any, Optional, Sequence, Tuple, Iterator
+from dotenv import load_dotenv
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import os
+
+load_dotenv()
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite")
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+    Content-addressed LLM response cache on local disk.
+    - Key: sha256 of the model's llm_string (model name, temperature, ...) + the serialized message list.
+    - Eviction: entries older than ttl_seconds are dropped; above max_entries the least recently used go first.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl_seconds and now - row[1] > self.ttl_seconds):
+                if row is not None:
+                    self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return [loads(g) for g in json.loads(row[0])]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        value = json.dumps([dumps(g) for g in return_val])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now))
+            self._evict(now)
+
+    def _evict(self, now: float):
+        if self.ttl_seconds:
+            self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if self.max_entries and count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,))
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count}
+
+
+_llm_cache: Optional[SQLiteLLMCache] = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache() -> SQLiteLLMCache:
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = SQLiteLLMCache()
+        return _llm_cache
+
+def llm_cache_stats() -> Dict[str, int]:
+    return get_llm_cache().stats()
+
+def stream_with_cache(llm, messages) -> Iterator[str]:
+    """
+    llm.stream(messages) as text deltas, through the model's response cache (LangChain only consults it
+    for invoke/batch).
+    - Same key as invoke, so streamed and batched runs share entries. That key comes from
+      BaseChatModel._get_llm_string, the one private call here; langchain-core is pinned for it.
+    - Hit: the cached text is yielded as one delta. Miss: deltas are streamed and the merged message is stored.
+    """
+    cache = llm.cache if isinstance(getattr(llm, "cache", None), BaseCache) else None
+    if cache is None:
+        for chunk in llm.stream(messages):
+            if chunk.content:
+                yield chunk.content
+        return
+    messages = convert_to_messages(messages)
+    prompt, llm_string = dumps(messages), llm._get_llm_string()
+    cached = cache.lookup(prompt, llm_string)
+    if cached:
+        yield cached[0].text
+        return
+    merged = None
+    for chunk in llm.stream(messages):
+        merged = chunk if merged is None else merged + chunk
+        if chunk.content:
+            yield chunk.content
+    if merged is not None:
+        cache.update(prompt, llm_string, [ChatGeneration(message=message_chunk_to_message(merged))])
+
+
+class SQLiteByteStore(ByteStore):
+    """
+    Key/value bytes on local disk; backs CacheBackedEmbeddings so a chunk text is only ever embedded once.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            # stay well under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                part = list(keys[i:i + 500])
+                marks = ",".join("?" * len(part))
+                found.update(self._conn.execute(f"SELECT key, value FROM kv WHERE key IN ({marks})", part).fetchall())
+        return [found.get(k) for k in keys]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", list(key_value_pairs))
+            self._conn.execute("COMMIT")
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            self._conn.executemany("DELETE FROM kv WHERE key = ?", [(k,) for k in keys])
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        with self._lock:
+            if prefix:
+                rows = self._conn.execute("SELECT key FROM kv WHERE key LIKE ? || '%'", (prefix,)).fetchall()
+            else:
+                rows = self._conn.execute("SELECT key FROM kv").fetchall()
+        for (k,) in rows:
+            yield k
+
+
+_embedding_store: Optional[SQLiteByteStore] = None
+
+def get_embedding_store() -> SQLiteByteStore:
+    global _embedding_store
+    with _llm_cache_lock:
+        if _embedding_store is None:
+            _embedding_store = SQLiteByteStore()
+        return _embedding_store
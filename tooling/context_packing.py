@@ -0,0 +1,245 @@
+from langchain_core.documents import Document
+from typing import TypedDict, List, Dict, Any, Optional
+from dotenv import load_dotenv
+import functools
+import os
+import re
+import tiktoken
+
+load_dotenv()
+
+NEAR_DUPLICATE_OVERLAP = float(os.getenv("CONTEXT_DEDUP_OVERLAP", "0.85"))  # share of a unit's word trigrams already sent
+MIN_TEXT_OVERLAP = 20  # chars a chunk's tail and the next chunk's head must share to be stitched
+MIN_SNIPPET_TOKENS = 48  # a leftover budget smaller than this is not worth a truncated fragment
+
+
+CHARS_PER_TOKEN = 4  # estimate used when the tokenizer files cannot be loaded
+
+
+@functools.lru_cache(maxsize=8)
+def _encoding(model: str):
+    # tiktoken fetches its BPE files on first use; offline (and nothing cached) fall back to the estimate
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+def encoding():
+    return _encoding(os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+
+def count_tokens(text: str) -> int:
+    enc = encoding()
+    if enc is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(enc.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    enc = encoding()
+    if enc is None:
+        return text[:max(0, max_tokens) * CHARS_PER_TOKEN]
+    tokens = enc.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else enc.decode(tokens[:max(0, max_tokens)])
+
+
+def _stitch(a: str, b: str) -> Optional[str]:
+    """
+    a + b without the text they share (b starting inside a's tail, as the splitter's chunk_overlap produces);
+    None if they do not overlap.
+    """
+    if b in a:
+        return a
+    head = b[:MIN_TEXT_OVERLAP]
+    if len(head) < MIN_TEXT_OVERLAP:
+        return None
+    pos = a.find(head, max(0, len(a) - len(b) - 1))
+    while pos >= 0:
+        if b.startswith(a[pos:]):
+            return a + b[len(a) - pos:]
+        pos = a.find(head, pos + 1)
+    return None
+
+def _key(d: Document) -> tuple:
+    m = d.metadata or {}
+    return (m.get("student_name"), m.get("source_file"), m.get("file_hash"))
+
+def _position(d: Document) -> tuple:
+    m = d.metadata or {}
+    return (m.get("chunk_index", -1), m.get("page", -1), m.get("start_index", -1))
+
+
+class _Unit:
+    __slots__ = ("text", "source", "rank", "members", "_grams")
+
+    def __init__(self, text: str, source: str, rank: tuple, members: List[int]):
+        self.text = text
+        self.source = source
+        self.rank = rank
+        self.members = members  # indices of the input docs stitched into this unit
+        self._grams = None
+
+    def trigrams(self) -> set:
+        if self._grams is None:
+            w = re.findall(r"\w+", self.text.lower())
+            self._grams = {tuple(w[i:i + 3]) for i in range(max(1, len(w) - 2))}
+        return self._grams
+
+    def snippet(self, tag_sources: bool) -> str:
+        return f"[{self.source}] {self.text.strip()}" if tag_sources else self.text.strip()
+
+
+def merge_overlapping(docs: List[Document], rank: str = "distance") -> List[_Unit]:
+    """
+    Chunks of the same file that are neighbours (their texts overlap, or consecutive chunk_index) become one unit.
+    A unit ranks as its best member: lowest metadata["distance"] with rank="distance", else earliest position.
+    """
+    def score(i: int, d: Document) -> tuple:
+        dist = (d.metadata or {}).get("distance")
+        return (dist if rank == "distance" and dist is not None else float("inf"), i)
+
+    groups: Dict[tuple, List[tuple]] = {}
+    for i, d in enumerate(docs):
+        groups.setdefault(_key(d), []).append((i, d))
+    units: List[_Unit] = []
+    for key, members in groups.items():
+        mergeable = key != (None, None, None)
+        members.sort(key=lambda p: _position(p[1]))
+        unit, last = None, None
+        for i, d in members:
+            pos = _position(d)[0]
+            stitched = _stitch(unit.text, d.page_content) if unit is not None and mergeable else None
+            if stitched is None and unit is not None and mergeable and pos >= 0 and pos == last + 1:
+                stitched = unit.text + "\n" + d.page_content  # consecutive chunks that happen not to overlap
+            if stitched is not None:
+                unit.text, unit.rank = stitched, min(unit.rank, score(i, d))
+                unit.members.append(i)
+            else:
+                unit = _Unit(d.page_content, key[1] or "?", score(i, d), [i])
+                units.append(unit)
+            last = pos
+    units.sort(key=lambda u: u.rank)
+    return units
+
+def _dedup(units: List[_Unit], threshold: float) -> tuple:
+    """
+    (kept units, {dropped unit index -> kept unit index}); `units` must be in rank order.
+    """
+    kept: List[_Unit] = []
+    alias: Dict[int, int] = {}
+    seen_text: Dict[str, int] = {}
+    for idx, u in enumerate(units):
+        norm = " ".join(u.text.split()).lower()
+        if not norm:
+            continue
+        if norm in seen_text:
+            alias[idx] = seen_text[norm]
+            continue
+        grams = u.trigrams()
+        dup = next((j for j, k in enumerate(kept) if len(grams & k.trigrams()) / max(1, len(grams)) >= threshold), None)
+        if dup is not None:
+            alias[idx] = dup
+            continue
+        seen_text[norm] = len(kept)
+        kept.append(u)
+    return kept, alias
+
+def drop_near_duplicates(units: List[_Unit], threshold: float = NEAR_DUPLICATE_OVERLAP) -> List[_Unit]:
+    """
+    Drops a unit when >= threshold of its word trigrams are contained in one better-ranked unit
+    (re-uploads, copies, a chunk already inside a stitched neighbour). `units` must be in rank order.
+    """
+    return _dedup(units, threshold)[0]
+
+def _fit(snippet: str, budget: int, first: bool) -> Optional[tuple]:
+    # (snippet, tokens) if it fits the budget; only a key's first snippet is cut down instead of skipped
+    n = count_tokens(snippet)
+    if n <= budget:
+        return snippet, n
+    if not first or budget < 1:
+        return None
+    return truncate_tokens(snippet, budget), budget
+
+def pack_context(docs: List[Document], max_tokens: int, rank: str = "distance", tag_sources: bool = True) -> List[str]:
+    """
+    Retrieved chunks -> prompt snippets that fit in max_tokens (counted with the model's tokenizer).
+    - Neighbouring chunks of a file are stitched back together (no repeated chunk_overlap text),
+      near-duplicates are dropped, then snippets are taken best-ranked first while they fit.
+    - rank="distance" orders by metadata["distance"] (retrieval score); rank="order" keeps the input order.
+    - The best snippet is cut to the budget if it does not fit whole, so the top evidence is never skipped.
+    """
+    out: List[str] = []
+    budget = max_tokens
+    for u in drop_near_duplicates(merge_overlapping(docs, rank=rank)):
+        if budget < MIN_SNIPPET_TOKENS and out:
+            break
+        fitted = _fit(u.snippet(tag_sources), budget, first=not out)
+        if fitted is None:
+            continue
+        out.append(fitted[0])
+        budget -= fitted[1]
+    return out
+
+def pack_contexts(docs_by_key: Dict[Any, List[Document]], max_tokens: int, tag_sources: bool = True) -> Dict[Any, List[str]]:
+    """
+    pack_context for several retrieval lists that share one prompt (e.g. every concept of one student's
+    batch grading call).
+    - Units are built over the union, so a chunk retrieved for several keys is stitched and deduplicated
+      once and every key that retrieved it gets the identical snippet string (sent once by the caller).
+    - Each key gets up to max_tokens of its own best-ranked units (by that key's retrieval distance), so every
+      key is judged on a bounded amount of evidence and the prompt stays under len(keys) * max_tokens.
+    - A unit longer than max_tokens is cut once, before any key takes it; a key then takes the unit whole or
+      skips it, so a shared chunk never reaches the prompt in two different truncations.
+    """
+    union: List[Document] = []
+    where: Dict[Any, int] = {}
+    hits: Dict[Any, Dict[int, tuple]] = {}
+    for key, docs in docs_by_key.items():
+        hits[key] = {}
+        for rank_pos, d in enumerate(docs):
+            ident = d.id or (d.metadata or {}).get("chunk_hash") or d.page_content
+            if ident not in where:
+                where[ident] = len(union)
+                union.append(d)
+            dist = (d.metadata or {}).get("distance")
+            hits[key].setdefault(where[ident], (dist if dist is not None else float("inf"), rank_pos))
+    ordered = merge_overlapping(union, rank="order")
+    units, alias = _dedup(ordered, NEAR_DUPLICATE_OVERLAP)
+    owner: Dict[int, int] = {}  # union doc index -> kept unit index
+    kept_pos = {id(u): j for j, u in enumerate(units)}
+    for idx, u in enumerate(ordered):
+        j = kept_pos.get(id(u), alias.get(idx))
+        if j is not None:
+            for m in u.members:
+                owner[m] = j
+    fitted_units: Dict[int, Optional[tuple]] = {}  # kept unit index -> (snippet, tokens), cut to max_tokens once
+    out: Dict[Any, List[str]] = {}
+    for key in docs_by_key:
+        best: Dict[int, tuple] = {}
+        for m, r in hits[key].items():
+            j = owner.get(m)
+            if j is not None and (j not in best or r < best[j]):
+                best[j] = r
+        budget, picked = max_tokens, []
+        for j in sorted(best, key=best.get):
+            if budget < MIN_SNIPPET_TOKENS and picked:
+                break
+            if j not in fitted_units:
+                fitted_units[j] = _fit(units[j].snippet(tag_sources), max_tokens, first=True)
+            fitted = fitted_units[j]
+            if fitted is None or fitted[1] > budget:
+                continue
+            picked.append(fitted[0])
+            budget -= fitted[1]
+        out[key] = picked
+    return out
+
+def interleave(lists: List[List[Document]]) -> List[Document]:
+    """
+    Round-robin over several ranked lists (e.g. one per weak concept), so a shared budget covers each of them.
+    """
+    out: List[Document] = []
+    for i in range(max((len(l) for l in lists), default=0)):
+        out.extend(l[i] for l in lists if i < len(l))
+    return out
@@ -0,0 +1,301 @@
+from langchain_core.callbacks import BaseCallbackHandler
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TypedDict, List, Dict, Any, Optional, Iterator
+from dotenv import load_dotenv
+import asyncio
+import functools
+import json
+import os
+import secrets
+import threading
+import time
+
+load_dotenv()
+
+# INSTRUMENTATION=0 turns every hook below into the undecorated function / a no-op at import time
+INSTRUMENTATION_ENABLED = os.getenv("INSTRUMENTATION", "1") != "0"
+TRACE_DIR = os.getenv("TRACE_DIR", ".cache/traces")
+
+_trace: ContextVar[Optional["Trace"]] = ContextVar("comprende_trace", default=None)
+_span: ContextVar[Optional["Span"]] = ContextVar("comprende_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "kind", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, kind: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.kind = kind
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration_s(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+
+class Trace:
+    """
+    One pipeline run: finished spans, latency samples per span name and counters
+    (llm.calls, llm.input_tokens, llm.output_tokens, sql.round_trips, ...). Thread-safe.
+    """
+
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = secrets.token_hex(16)
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.spans: List[Span] = []
+        self.latencies: Dict[str, List[float]] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def finish_span(self, span: Span):
+        span.end_ns = time.time_ns()
+        with self._lock:
+            self.spans.append(span)
+            self.latencies.setdefault(span.name, []).append(span.duration_s)
+
+    def add(self, counter: str, n: float = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Latency histogram per span name (count, total, p50, p95, max in seconds) plus the counters.
+        """
+        with self._lock:
+            latencies = {k: sorted(v) for k, v in self.latencies.items()}
+            counters = dict(self.counters)
+        def pct(vals, q):
+            return vals[min(len(vals) - 1, int(q * len(vals)))]
+        spans = {
+            name: {"count": len(v), "total_s": round(sum(v), 4), "p50_s": round(pct(v, 0.5), 4),
+                   "p95_s": round(pct(v, 0.95), 4), "max_s": round(v[-1], 4)}
+            for name, v in sorted(latencies.items())
+        }
+        wall = ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+        return {"wall_s": round(wall, 4), "spans": spans, "counters": counters}
+
+    def to_otel(self) -> Dict[str, Any]:
+        """
+        OTLP/JSON-shaped export (resourceSpans -> scopeSpans -> spans), with the summary alongside.
+        """
+        def attrs(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+            out = []
+            for k, v in d.items():
+                if isinstance(v, bool):
+                    val = {"boolValue": v}
+                elif isinstance(v, int):
+                    val = {"intValue": str(v)}
+                elif isinstance(v, float):
+                    val = {"doubleValue": v}
+                else:
+                    val = {"stringValue": str(v)}
+                out.append({"key": k, "value": val})
+            return out
+        with self._lock:
+            spans = list(self.spans)
+        root_id = "0" * 16
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": attrs({"service.name": "comprende", **self.attributes})},
+                "scopeSpans": [{
+                    "scope": {"name": "tooling.instrumentation"},
+                    "spans": [{
+                        "traceId": self.trace_id,
+                        "spanId": root_id,
+                        "name": self.name,
+                        "kind": "SPAN_KIND_INTERNAL",
+                        "startTimeUnixNano": str(self.start_ns),
+                        "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+                        "attributes": [],
+                        "status": {},
+                    }] + [{
+                        "traceId": self.trace_id,
+                        "spanId": s.span_id,
+                        "parentSpanId": s.parent_id or root_id,
+                        "name": s.name,
+                        "kind": f"SPAN_KIND_{s.kind.upper()}",
+                        "startTimeUnixNano": str(s.start_ns),
+                        "endTimeUnixNano": str(s.end_ns),
+                        "attributes": attrs(s.attributes),
+                        "status": {"code": "STATUS_CODE_ERROR", "message": s.error} if s.error else {},
+                    } for s in spans],
+                }],
+            }],
+            "summary": self.summary(),
+        }
+
+    def export(self, directory: str = TRACE_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"trace-{time.strftime('%Y%m%d-%H%M%S')}-{self.trace_id[:8]}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_otel(), f, indent=1)
+        return path
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+@contextmanager
+def trace_run(name: str, attributes: Optional[Dict[str, Any]] = None, export: bool = True) -> Iterator[Optional[Trace]]:
+    """
+    Collects everything instrumented below it into one Trace and writes it to TRACE_DIR on exit.
+    Nested calls reuse the outer trace; with instrumentation disabled this yields None.
+    """
+    outer = _trace.get()
+    if not INSTRUMENTATION_ENABLED or outer is not None:
+        yield outer
+        return
+    trace = Trace(name, attributes)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        trace.end_ns = time.time_ns()
+        if export:
+            trace.attributes["trace_file"] = trace.export()
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes) -> Iterator[Optional[Span]]:
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _span.get()
+    s = Span(name, kind, parent.span_id if parent else None, attributes)
+    token = _span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _span.reset(token)
+        trace.finish_span(s)
+
+def count(counter: str, n: float = 1):
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(counter, n)
+
+def traced(name: Optional[str] = None, kind: str = "internal"):
+    """
+    Decorator: run the function (sync or async) inside a span named `name` (default module.function).
+    Returns the function itself when instrumentation is disabled; otherwise a call outside any trace
+    costs one context-variable lookup.
+    """
+    def wrap(fn):
+        if not INSTRUMENTATION_ENABLED:
+            return fn
+        label = name or f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def arun(*args, **kwargs):
+                if _trace.get() is None:
+                    return await fn(*args, **kwargs)
+                with span(label, kind):
+                    return await fn(*args, **kwargs)
+            return arun
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            if _trace.get() is None:
+                return fn(*args, **kwargs)
+            with span(label, kind):
+                return fn(*args, **kwargs)
+        return run
+    return wrap
+
+
+class LLMUsageCallback(BaseCallbackHandler):
+    """
+    One "llm.call" client span per chat completion, with token usage; feeds llm.* counters.
+    """
+    run_inline = True  # keep the caller's context (and so its trace) for async runs
+
+    def __init__(self):
+        self._open: Dict[Any, tuple] = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        trace = _trace.get()
+        if trace is None:
+            return
+        parent = _span.get()
+        model = ((kwargs.get("invocation_params") or {}).get("model")
+                 or (kwargs.get("invocation_params") or {}).get("model_name") or "")
+        with self._lock:
+            self._open[run_id] = (trace, Span("llm.call", "client", parent.span_id if parent else None,
+                                              {"llm.model": model}))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            opened = self._open.pop(run_id, None)
+        if opened is None:
+            return
+        trace, s = opened
+        usage = {"input_tokens": 0, "output_tokens": 0}
+        for gens in response.generations:
+            for g in gens:
+                meta = getattr(getattr(g, "message", None), "usage_metadata", None) or {}
+                usage["input_tokens"] += meta.get("input_tokens", 0)
+                usage["output_tokens"] += meta.get("output_tokens", 0)
+        if not any(usage.values()):
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            usage = {"input_tokens": token_usage.get("prompt_tokens", 0), "output_tokens": token_usage.get("completion_tokens", 0)}
+        s.attributes.update({"llm.input_tokens": usage["input_tokens"], "llm.output_tokens": usage["output_tokens"]})
+        trace.finish_span(s)
+        trace.add("llm.calls")
+        trace.add("llm.input_tokens", usage["input_tokens"])
+        trace.add("llm.output_tokens", usage["output_tokens"])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            opened = self._open.pop(run_id, None)
+        if opened is not None:
+            trace, s = opened
+            s.error = f"{type(error).__name__}: {error}"
+            trace.finish_span(s)
+            trace.add("llm.errors")
+
+_llm_callback = LLMUsageCallback()
+
+def llm_callbacks() -> Optional[List[BaseCallbackHandler]]:
+    return [_llm_callback] if INSTRUMENTATION_ENABLED else None
+
+
+def instrument_engine(engine):
+    """
+    Counts SQL round trips (one per cursor execute / executemany) and records an "sql.execute" span each.
+    """
+    if not INSTRUMENTATION_ENABLED:
+        return engine
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_instr_started", []).append(time.time_ns())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("_instr_started", [])
+        start_ns = started.pop() if started else time.time_ns()
+        trace = _trace.get()
+        if trace is None:
+            return
+        parent = _span.get()
+        s = Span("sql.execute", "client", parent.span_id if parent else None,
+                 {"db.statement": " ".join(statement.split())[:200],
+                  "db.rows": len(parameters) if executemany else 1})
+        s.start_ns = start_ns
+        trace.finish_span(s)
+        trace.add("sql.round_trips")
+    return engine
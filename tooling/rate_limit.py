@@ -0,0 +1,78 @@
+from langchain_core.rate_limiters import BaseRateLimiter
+from typing import TypedDict, List, Dict, Any, Optional
+from dotenv import load_dotenv
+import asyncio
+import multiprocessing
+import os
+import time
+
+load_dotenv()
+
+LLM_REQUESTS_PER_SECOND = float(os.getenv("LLM_REQUESTS_PER_SECOND", "0"))  # 0 = unlimited
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "10"))
+
+
+class SharedRateLimiter(BaseRateLimiter):
+    """
+    Token bucket whose state lives in shared memory, so every process of a batch run draws from one
+    requests-per-second budget (pass it to pool workers through the initializer, see batch.py).
+    - Each LLM request takes one token; tokens refill at requests_per_second up to max_bucket_size.
+    """
+
+    def __init__(self, requests_per_second: float, max_bucket_size: int = LLM_RATE_BURST,
+                 check_every_n_seconds: float = 0.05, ctx=None):
+        ctx = ctx or multiprocessing.get_context("spawn")
+        self.requests_per_second = requests_per_second
+        self.max_bucket_size = max(1, max_bucket_size)
+        self.check_every_n_seconds = check_every_n_seconds
+        self._lock = ctx.Lock()
+        self._tokens = ctx.RawValue("d", 0.0)
+        self._last = ctx.RawValue("d", 0.0)
+
+    def _consume(self) -> bool:
+        with self._lock:
+            now = time.time()
+            if self._last.value == 0.0:
+                self._last.value = now
+            elapsed = now - self._last.value
+            if elapsed * self.requests_per_second >= 1:
+                self._tokens.value = min(self._tokens.value + elapsed * self.requests_per_second, self.max_bucket_size)
+                self._last.value = now
+            if self._tokens.value >= 1:
+                self._tokens.value -= 1
+                return True
+            return False
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        if not blocking:
+            return self._consume()
+        while not self._consume():
+            time.sleep(self.check_every_n_seconds)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        if not blocking:
+            return self._consume()
+        while not self._consume():
+            await asyncio.sleep(self.check_every_n_seconds)
+        return True
+
+
+_rate_limiter: Optional[BaseRateLimiter] = None
+_rate_limiter_env_checked = False
+
+def set_rate_limiter(limiter: Optional[BaseRateLimiter]):
+    """
+    Process-wide limiter handed to every client get_llm() builds (batch workers install the shared one).
+    """
+    global _rate_limiter, _rate_limiter_env_checked
+    _rate_limiter = limiter
+    _rate_limiter_env_checked = True
+
+def get_rate_limiter() -> Optional[BaseRateLimiter]:
+    global _rate_limiter, _rate_limiter_env_checked
+    if not _rate_limiter_env_checked:
+        _rate_limiter_env_checked = True
+        if LLM_REQUESTS_PER_SECOND > 0:
+            _rate_limiter = SharedRateLimiter(LLM_REQUESTS_PER_SECOND)
+    return _rate_limiter
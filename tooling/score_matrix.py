@@ -0,0 +1,130 @@
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import TypedDict, List, Dict, Any, Optional, Iterator
+import hashlib
+import numpy as np
+
+
+@dataclass(eq=False)
+class ScoreMatrix(Mapping):
+    """
+    Students x concepts scores as one float32 array (NaN = not graded) plus name -> index maps.
+    - Reads like the old Dict[str, Dict[str, float]]: scores[s][c], scores.items(), scores.get(s).
+    - Cohort statistics (medians, percentiles, threshold masks, weak lists) are vectorized over the array.
+    - A dataclass of lists + ndarray, so LangGraph's checkpoint serializer stores it as raw array bytes.
+    """
+    students: List[str]
+    concepts: List[str]
+    values: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        self.students = list(self.students)
+        self.concepts = list(self.concepts)
+        shape = (len(self.students), len(self.concepts))
+        if self.values is None:
+            self.values = np.full(shape, np.nan, dtype=np.float32)
+        else:
+            self.values = np.asarray(self.values, dtype=np.float32).reshape(shape)
+        # plain attributes, not dataclass fields: the serializer rebuilds from the three fields above
+        self._s_idx = {s: i for i, s in enumerate(self.students)}
+        self._c_idx = {c: j for j, c in enumerate(self.concepts)}
+
+    @classmethod
+    def from_dict(cls, scores: Dict[str, Dict[str, float]], concepts: Optional[List[str]] = None) -> "ScoreMatrix":
+        if isinstance(scores, ScoreMatrix):
+            return scores
+        if concepts is None:
+            concepts = list(dict.fromkeys(c for m in scores.values() for c in m))
+        sm = cls(list(scores), concepts)
+        for i, m in enumerate(scores.values()):
+            for c, v in m.items():
+                j = sm._c_idx.get(c)
+                if j is not None:
+                    sm.values[i, j] = v
+        return sm
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        return {s: self[s] for s in self.students}
+
+    # --- dict-compatible view ---
+    def __getitem__(self, student: str) -> Dict[str, float]:
+        row = self.values[self._s_idx[student]]
+        # round away float32 noise so e.g. 72.3 reads back as 72.3
+        return {c: round(v, 4) for c, v in zip(self.concepts, row.tolist()) if v == v}
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.students)
+
+    def __len__(self) -> int:
+        return len(self.students)
+
+    def set(self, student: str, concept: str, score: float):
+        self.values[self._s_idx[student], self._c_idx[concept]] = score
+
+    def score(self, student: str, concept: str, default: float = 0.0) -> float:
+        i, j = self._s_idx.get(student), self._c_idx.get(concept)
+        if i is None or j is None or np.isnan(self.values[i, j]):
+            return default
+        return round(float(self.values[i, j]), 4)
+
+    def records(self) -> List[tuple]:
+        """
+        (student, concept, score) for every graded cell, row-major.
+        """
+        rows, cols = np.nonzero(~np.isnan(self.values))
+        vals = self.values[rows, cols].tolist()
+        return [(self.students[i], self.concepts[j], round(v, 4)) for i, j, v in zip(rows.tolist(), cols.tolist(), vals)]
+
+    # --- vectorized cohort analytics ---
+    def filled(self, fill: float = 0.0) -> np.ndarray:
+        """
+        Scores with ungraded cells set to `fill` (the old code's `.get(c, 0)`).
+        """
+        return np.nan_to_num(self.values, nan=fill)
+
+    def columns(self, concepts: List[str], fill: float = np.nan) -> np.ndarray:
+        """
+        (students, len(concepts)) block in the given concept order; unknown concepts are `fill`.
+        """
+        out = np.full((len(self.students), len(concepts)), fill, dtype=np.float32)
+        for k, c in enumerate(concepts):
+            j = self._c_idx.get(c)
+            if j is not None:
+                out[:, k] = self.values[:, j] if np.isnan(fill) else np.nan_to_num(self.values[:, j], nan=fill)
+        return out
+
+    def percentile(self, q: float, method: str = "higher", fill: float = 0.0) -> Dict[str, float]:
+        """
+        Per-concept percentile. method="higher" with q=50 is the old sorted(vals)[len(vals)//2].
+        """
+        if not self.students:
+            return {c: fill for c in self.concepts}
+        vals = np.percentile(self.filled(fill), q, axis=0, method=method)
+        return dict(zip(self.concepts, vals.tolist()))
+
+    def median(self, fill: float = 0.0) -> Dict[str, float]:
+        return self.percentile(50, method="higher", fill=fill)
+
+    def below(self, threshold: float, fill: Optional[float] = None) -> np.ndarray:
+        """
+        Boolean (students, concepts) mask of scores < threshold; ungraded cells count only if `fill` is given.
+        """
+        vals = self.values if fill is None else self.filled(fill)
+        return vals < threshold
+
+    def weak_concepts(self, student: str, threshold: float) -> List[str]:
+        row = self.values[self._s_idx[student]]
+        return [self.concepts[j] for j in np.flatnonzero(row < threshold)]
+
+    def weak_by_student(self, threshold: float) -> Dict[str, List[str]]:
+        mask = self.below(threshold)
+        return {s: [self.concepts[j] for j in np.flatnonzero(mask[i])] for i, s in enumerate(self.students)}
+
+    def fingerprint(self) -> str:
+        h = hashlib.sha256()
+        h.update("\x00".join(self.students).encode("utf-8"))
+        h.update(b"\x01")
+        h.update("\x00".join(self.concepts).encode("utf-8"))
+        h.update(b"\x01")
+        h.update(np.ascontiguousarray(self.values).tobytes())
+        return h.hexdigest()
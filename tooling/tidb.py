@@ -1,11 +1,31 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, bindparam
 from sqlalchemy.engine import Engine
 from typing import TypedDict, List, Dict, Any, Optional
 from dotenv import load_dotenv
+import hashlib
 import os
+import re
+import threading
+from .score_matrix import ScoreMatrix
+from .instrumentation import traced, instrument_engine
 
 load_dotenv()
 
+TIDB_POOL_SIZE = int(os.getenv("TIDB_POOL_SIZE", "10"))
+TIDB_MAX_OVERFLOW = int(os.getenv("TIDB_MAX_OVERFLOW", "10"))
+TIDB_POOL_RECYCLE = int(os.getenv("TIDB_POOL_RECYCLE", "300"))  # TiDB Cloud drops idle connections
+TIDB_POOL_WARMUP = int(os.getenv("TIDB_POOL_WARMUP", "2"))
+TIDB_WRITE_BATCH = int(os.getenv("TIDB_WRITE_BATCH", "500"))  # rows per multi-row INSERT
+WEAK_SCORE = 70  # concept_run_stats.weak_students counts scores below this
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX", "1") != "0"  # HNSW index on vector tables (needs TiFlash)
+VECTOR_TIFLASH_REPLICAS = int(os.getenv("VECTOR_TIFLASH_REPLICAS", "1"))
+
+_engines: Dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+_schema_ready: set = set()  # engine URLs whose schema this process has already ensured
+_schema_lock = threading.Lock()
+_vector_tables: Dict[tuple, Dict[str, Any]] = {}  # (engine URL, table) -> provision_vector_table() result
+
 
 def tidb_connection_string() -> str:
     user = os.getenv("TIDB_USER")
@@ -15,14 +35,75 @@ def tidb_connection_string() -> str:
     db = os.getenv("TIDB_DATABASE", "test")
     return f"mysql+pymysql://{user}:{pwd}@{host}:{port}/{db}?ssl_ca='cert.pem'&ssl_verify_cert=true&ssl_verify_identity=true"
 
-def get_engine() -> Engine:
-    return create_engine(tidb_connection_string(), pool_pre_ping=True)
+def engine_args() -> Dict[str, Any]:
+    return {
+        "pool_pre_ping": True,
+        "pool_size": TIDB_POOL_SIZE,
+        "max_overflow": TIDB_MAX_OVERFLOW,
+        "pool_recycle": TIDB_POOL_RECYCLE,
+    }
+
+def get_engine(connection_string: Optional[str] = None) -> Engine:
+    """
+    Process-wide Engine per connection string; every caller shares one connection pool.
+    """
+    url = connection_string or tidb_connection_string()
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = instrument_engine(create_engine(url, **engine_args()))
+            if TIDB_POOL_WARMUP:
+                warm_up(engine, TIDB_POOL_WARMUP)
+            _engines[url] = engine
+    return engine
+
+def warm_up(engine: Engine, connections: int):
+    """
+    Open (and return to the pool) a few connections up front so the first queries skip the TLS handshake.
+    """
+    conns = []
+    try:
+        for _ in range(min(connections, TIDB_POOL_SIZE)):
+            conn = engine.connect()
+            conn.execute(text("SELECT 1"))
+            conns.append(conn)
+    finally:
+        for conn in conns:
+            conn.close()
+
+def pool_stats() -> Dict[str, Dict[str, int]]:
+    with _engines_lock:
+        engines = list(_engines.values())
+    return {
+        e.url.render_as_string(hide_password=True): {
+            "size": e.pool.size(),
+            "checked_in": e.pool.checkedin(),
+            "checked_out": e.pool.checkedout(),
+            "overflow": e.pool.overflow(),
+        }
+        for e in engines
+    }
 
-def ensure_relational_schema(engine: Engine):
+def dispose_engines():
+    with _engines_lock:
+        for e in _engines.values():
+            e.dispose()
+        _engines.clear()
+
+def ensure_relational_schema(engine: Engine, force: bool = False):
     """
     Create normalized tables for comprehension, knowledge graph, groups, lessons, homework.
     Vector tables are created by TiDBVectorStore via LangChain.
+    Runs once per database per process (UI reruns and batch workers call it freely); force=True re-checks.
     """
+    key = str(engine.url)
+    with _schema_lock:
+        if key in _schema_ready and not force:
+            return
+        _create_schema(engine)
+        _schema_ready.add(key)
+
+def _create_schema(engine: Engine):
     with engine.begin() as conn:
         conn.execute(text("""
         CREATE TABLE IF NOT EXISTS students (
@@ -41,6 +122,7 @@ def ensure_relational_schema(engine: Engine):
             concept VARCHAR(255),
             score FLOAT,
             pain_points TEXT,
+            evidence_hash CHAR(64),
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             INDEX idx_student (student_name),
             INDEX idx_concept (concept),
@@ -54,6 +136,7 @@ def ensure_relational_schema(engine: Engine):
             student_name VARCHAR(255),
             concept VARCHAR(255),
             awareness_score FLOAT,
+            UNIQUE KEY uk_sc_student_concept (student_name, concept),
             INDEX idx_sc_student (student_name),
             INDEX idx_sc_concept (concept),
             FOREIGN KEY (student_name) REFERENCES students(student_name) ON DELETE CASCADE,
@@ -65,6 +148,7 @@ def ensure_relational_schema(engine: Engine):
             id BIGINT PRIMARY KEY AUTO_INCREMENT,
             group_id INT,
             student_name VARCHAR(255),
+            UNIQUE KEY uk_group_student (student_name),
             INDEX idx_group (group_id),
             INDEX idx_group_student (group_id, student_name)
         )"""))
@@ -85,48 +169,486 @@ def ensure_relational_schema(engine: Engine):
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )"""))
 
-def upsert_students_and_concepts(engine: Engine, student_names: List[str], concepts: List[str]):
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS student_reports (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            student_name VARCHAR(255),
+            report TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_report_student (student_name, id)
+        )"""))
+
+        # one row per file fully ingested into a vector table; lets re-uploads of unchanged PDFs be skipped
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            table_name VARCHAR(64),
+            student_name VARCHAR(255),
+            source_file VARCHAR(512),
+            file_hash CHAR(64),
+            chunk_count INT,
+            ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (table_name, student_name, source_file)
+        )"""))
+
+        # tables created before the upsert writers existed lack their unique keys: keep the newest row
+        # (MAX(id)) per key, drop the older duplicates, then add the key
+        for table, key, cols in [("student_concepts", "uk_sc_student_concept", ("student_name", "concept")),
+                                 ("study_groups", "uk_group_student", ("student_name",))]:
+            if not _has_index(conn, table, key):
+                match = " AND ".join(f"t.{c} <=> k.{c}" for c in cols)
+                conn.execute(text(f"""
+                    DELETE t FROM {table} t
+                    JOIN (SELECT {', '.join(cols)}, MAX(id) AS keep_id FROM {table} GROUP BY {', '.join(cols)}) k
+                      ON {match} AND t.id < k.keep_id"""))
+                conn.execute(text(f"ALTER TABLE {table} ADD UNIQUE KEY {key} ({', '.join(cols)})"))
+
+        if not _has_column(conn, "comprehension", "evidence_hash"):
+            conn.execute(text("ALTER TABLE comprehension ADD COLUMN evidence_hash CHAR(64)"))
+
+        # "latest row per key" reads (load_latest_results) resolve MAX(id) from these without a table scan
+        for table, key, cols in [("comprehension", "idx_comp_latest", "student_name, concept, id"),
+                                 ("lesson_plans", "idx_lp_latest", "concept, id"),
+                                 ("homework_personalized", "idx_hw_latest", "student_name, id")]:
+            if not _has_index(conn, table, key):
+                conn.execute(text(f"ALTER TABLE {table} ADD INDEX {key} ({cols})"))
+
+        # every result row records the pipeline run that produced it (NULL for rows from before run ids)
+        for table in ("comprehension", "student_concepts", "study_groups", "lesson_plans",
+                      "homework_personalized", "student_reports"):
+            if not _has_column(conn, table, "run_id"):
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN run_id VARCHAR(32)"))
+        for table, key, cols in [("comprehension", "idx_comp_history", "student_name, concept, created_at"),
+                                 ("comprehension", "uk_comp_run", "run_id, student_name, concept"),
+                                 ("lesson_plans", "idx_lp_run", "run_id, concept"),
+                                 ("homework_personalized", "idx_hw_run", "run_id, student_name"),
+                                 ("student_reports", "idx_report_run", "run_id, student_name")]:
+            if not _has_index(conn, table, key):
+                kind = "UNIQUE KEY" if key.startswith("uk_") else "INDEX"
+                conn.execute(text(f"ALTER TABLE {table} ADD {kind} {key} ({cols})"))
+
+        # rollups: the latest score per pair (write_comprehension_batch) and per-run concept stats
+        # (refresh_concept_run_stats, once a run has scored every student)
+        backfill = not _has_table(conn, "comprehension_latest")
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS comprehension_latest (
+            student_name VARCHAR(255),
+            concept VARCHAR(255),
+            score FLOAT,
+            pain_points TEXT,
+            evidence_hash CHAR(64),
+            run_id VARCHAR(32),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (student_name, concept)
+        )"""))
+        if backfill:
+            conn.execute(text("""
+            INSERT IGNORE INTO comprehension_latest (student_name, concept, score, pain_points, evidence_hash, run_id)
+            SELECT c.student_name, c.concept, c.score, c.pain_points, c.evidence_hash, c.run_id
+            FROM comprehension c
+            JOIN (SELECT MAX(id) AS id FROM comprehension GROUP BY student_name, concept) latest ON c.id = latest.id"""))
+
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS concept_run_stats (
+            run_id VARCHAR(32),
+            concept VARCHAR(255),
+            students INT,
+            score_sum DOUBLE,
+            min_score FLOAT,
+            max_score FLOAT,
+            weak_students INT,
+            run_at TIMESTAMP,
+            PRIMARY KEY (run_id, concept),
+            INDEX idx_crs_concept_time (concept, run_at)
+        )"""))
+
+def _has_table(conn, table: str) -> bool:
+    return conn.execute(
+        text("""SELECT COUNT(*) FROM information_schema.tables
+                WHERE table_schema = DATABASE() AND table_name = :t"""),
+        {"t": table}
+    ).scalar() > 0
+
+def _has_index(conn, table: str, index: str) -> bool:
+    return conn.execute(
+        text("""SELECT COUNT(*) FROM information_schema.statistics
+                WHERE table_schema = DATABASE() AND table_name = :t AND index_name = :i"""),
+        {"t": table, "i": index}
+    ).scalar() > 0
+
+def _has_column(conn, table: str, column: str) -> bool:
+    return conn.execute(
+        text("""SELECT COUNT(*) FROM information_schema.columns
+                WHERE table_schema = DATABASE() AND table_name = :t AND column_name = :c"""),
+        {"t": table, "c": column}
+    ).scalar() > 0
+
+def _executemany(conn, stmt, rows: List[Dict[str, Any]], batch_size: Optional[int] = None):
+    # PyMySQL rewrites executemany of INSERT ... VALUES into multi-row VALUES: one round trip per batch
+    batch_size = batch_size or TIDB_WRITE_BATCH
+    for i in range(0, len(rows), batch_size):
+        conn.execute(stmt, rows[i:i + batch_size])
+
+@traced("tidb.upsert_students_and_concepts")
+def upsert_students_and_concepts(engine: Engine, student_names: List[str], concepts: List[str],
+                                 batch_size: Optional[int] = None):
     with engine.begin() as conn:
-        for s in student_names:
-            conn.execute(text("INSERT IGNORE INTO students(student_name) VALUES (:s)"), {"s": s})
-        for c in concepts:
-            conn.execute(text("INSERT IGNORE INTO concepts(concept) VALUES (:c)"), {"c": c})
+        _executemany(conn, text("INSERT IGNORE INTO students(student_name) VALUES (:s)"),
+                     [{"s": s} for s in student_names], batch_size)
+        _executemany(conn, text("INSERT IGNORE INTO concepts(concept) VALUES (:c)"),
+                     [{"c": c} for c in concepts], batch_size)
 
-def write_comprehension(engine: Engine, student_name: str, concept: str, score: float, pain_points: List[str]):
+@traced("tidb.write_comprehension_batch")
+def write_comprehension_batch(engine: Engine, scores: Dict[str, Dict[str, float]],
+                              pain_points: Dict[str, Dict[str, List[str]]],
+                              evidence_hashes: Optional[Dict[str, Dict[str, str]]] = None,
+                              batch_size: Optional[int] = None, run_id: Optional[str] = None):
+    """
+    Whole score matrix in one transaction, multi-row INSERTs of batch_size rows.
+    evidence_hashes fingerprints the homework chunks each score was based on (used by incremental runs).
+    The comprehension_latest rollup is upserted with the same rows in the same transaction; a row there is
+    only replaced by one from the same or a later run (run ids sort by start time).
+    students / concepts rows must exist (upsert_students_and_concepts): a missing one fails the write.
+    """
+    evidence_hashes = evidence_hashes or {}
+    rows = [
+        {"s": s, "c": c, "score": float(v), "pp": "\n".join(pain_points.get(s, {}).get(c, [])),
+         "eh": evidence_hashes.get(s, {}).get(c), "r": run_id}
+        for s, m in scores.items() for c, v in m.items()
+    ]
+    if not rows:
+        return
     with engine.begin() as conn:
-        conn.execute(
-            text("""INSERT IGNORE INTO comprehension (student_name, concept, score, pain_points)
-                    VALUES (:s, :c, :score, :pp)"""),
-            {"s": student_name, "c": concept, "score": float(score), "pp": "\n".join(pain_points)}
-        )
+        # a resumed run rewrites its own rows (uk_comp_run)
+        _executemany(conn, text("""INSERT INTO comprehension (student_name, concept, score, pain_points, evidence_hash, run_id)
+                                   VALUES (:s, :c, :score, :pp, :eh, :r)
+                                   ON DUPLICATE KEY UPDATE score = VALUES(score), pain_points = VALUES(pain_points),
+                                       evidence_hash = VALUES(evidence_hash)"""), rows, batch_size)
+        # run_id is assigned last: MySQL evaluates the assignments left to right
+        newer = "(VALUES(run_id) IS NULL OR run_id IS NULL OR VALUES(run_id) >= run_id)"
+        _executemany(conn, text(f"""INSERT INTO comprehension_latest (student_name, concept, score, pain_points, evidence_hash, run_id)
+                                    VALUES (:s, :c, :score, :pp, :eh, :r)
+                                    ON DUPLICATE KEY UPDATE score = IF({newer}, VALUES(score), score),
+                                        pain_points = IF({newer}, VALUES(pain_points), pain_points),
+                                        evidence_hash = IF({newer}, VALUES(evidence_hash), evidence_hash),
+                                        run_id = IF({newer}, VALUES(run_id), run_id)"""), rows, batch_size)
 
-def write_student_concepts(engine: Engine, scores: Dict[str, Dict[str, float]]):
+@traced("tidb.refresh_concept_run_stats")
+def refresh_concept_run_stats(engine: Engine, run_id: str, concepts: List[str], weak_threshold: float = WEAK_SCORE):
+    """
+    Re-aggregates one run's concept_run_stats rows from that run's comprehension rows (one statement over
+    uk_comp_run). Idempotent, so re-running it after a resumed run never double counts.
+    """
+    if not run_id or not concepts:
+        return
     with engine.begin() as conn:
-        conn.execute(text("DELETE FROM student_concepts"))
-        for s, m in scores.items():
-            for c, v in m.items():
-                conn.execute(
-                    text("""INSERT INTO student_concepts (student_name, concept, awareness_score)
-                            VALUES (:s, :c, :v)"""),
-                    {"s": s, "c": c, "v": float(v)}
-                )
-
-def write_study_groups(engine: Engine, groups: Dict[int, List[str]]):
+        conn.execute(text("""
+            INSERT INTO concept_run_stats (run_id, concept, students, score_sum, min_score, max_score, weak_students, run_at)
+            SELECT run_id, concept, COUNT(*), SUM(score), MIN(score), MAX(score), SUM(score < :weak), MIN(created_at)
+            FROM comprehension WHERE run_id = :r AND concept IN :c
+            GROUP BY run_id, concept
+            ON DUPLICATE KEY UPDATE students = VALUES(students), score_sum = VALUES(score_sum),
+                min_score = VALUES(min_score), max_score = VALUES(max_score),
+                weak_students = VALUES(weak_students), run_at = VALUES(run_at)""").bindparams(
+            bindparam("c", expanding=True)),
+            {"r": run_id, "c": list(concepts), "weak": weak_threshold})
+
+@traced("tidb.latest_comprehension")
+def latest_comprehension(engine: Engine, student_names: List[str], concepts: List[str]) -> Dict[tuple, Dict[str, Any]]:
+    """
+    Most recent comprehension row per (student, concept): {(s, c): {"score", "pain_points", "evidence_hash", "run_id"}}.
+    Primary-key reads of the comprehension_latest rollup; no scan of the history.
+    """
+    if not student_names or not concepts:
+        return {}
+    stmt = text("""
+        SELECT student_name, concept, score, pain_points, evidence_hash, run_id
+        FROM comprehension_latest
+        WHERE student_name IN :s AND concept IN :c""").bindparams(
+        bindparam("s", expanding=True), bindparam("c", expanding=True))
+    with engine.connect() as conn:
+        rows = conn.execute(stmt, {"s": list(student_names), "c": list(concepts)}).fetchall()
+    return {
+        (r[0], r[1]): {"score": float(r[2]), "pain_points": [p for p in (r[3] or "").split("\n") if p], "evidence_hash": r[4],
+                      "run_id": r[5]}
+        for r in rows
+    }
+
+@traced("tidb.write_student_concepts")
+def write_student_concepts(engine: Engine, scores: Dict[str, Dict[str, float]], mode: str = "upsert",
+                           batch_size: Optional[int] = None, run_id: Optional[str] = None):
+    """
+    mode="upsert" updates rows in place (ON DUPLICATE KEY UPDATE), then deletes these students' rows for
+    concepts no longer in `scores`; other classes' rows are untouched. mode="replace" clears the table first.
+    """
+    sm = ScoreMatrix.from_dict(scores)
+    rows = [{"s": s, "c": c, "v": v, "r": run_id} for s, c, v in sm.records()]
+    with engine.begin() as conn:
+        if mode == "replace":
+            conn.execute(text("DELETE FROM student_concepts"))
+        _executemany(conn, text("""INSERT INTO student_concepts (student_name, concept, awareness_score, run_id)
+                                   VALUES (:s, :c, :v, :r)
+                                   ON DUPLICATE KEY UPDATE awareness_score = VALUES(awareness_score), run_id = VALUES(run_id)"""),
+                     rows, batch_size)
+        if mode == "upsert" and sm.students and sm.concepts:
+            conn.execute(text("DELETE FROM student_concepts WHERE student_name IN :s AND concept NOT IN :c").bindparams(
+                bindparam("s", expanding=True), bindparam("c", expanding=True)),
+                {"s": list(sm.students), "c": list(sm.concepts)})
+
+@traced("tidb.write_study_groups")
+def write_study_groups(engine: Engine, groups: Dict[int, List[str]], mode: str = "upsert",
+                       batch_size: Optional[int] = None, run_id: Optional[str] = None):
+    """
+    mode="upsert" moves each student to their new group in place (one row per student, so nothing of this
+    class goes stale); mode="replace" clears the table first.
+    """
+    rows = [{"g": gid, "s": s, "r": run_id} for gid, members in groups.items() for s in members]
+    with engine.begin() as conn:
+        if mode == "replace":
+            conn.execute(text("DELETE FROM study_groups"))
+        _executemany(conn, text("""INSERT INTO study_groups (group_id, student_name, run_id) VALUES (:g, :s, :r)
+                                   ON DUPLICATE KEY UPDATE group_id = VALUES(group_id), run_id = VALUES(run_id)"""),
+                     rows, batch_size)
+
+@traced("tidb.write_lesson_plans")
+def write_lesson_plans(engine: Engine, plans: Dict[str, str], batch_size: Optional[int] = None,
+                       run_id: Optional[str] = None):
     with engine.begin() as conn:
-        conn.execute(text("DELETE FROM study_groups"))
-        for gid, members in groups.items():
-            for s in members:
-                conn.execute(text("INSERT INTO study_groups (group_id, student_name) VALUES (:g, :s)"),
-                             {"g": gid, "s": s})
+        _executemany(conn, text("INSERT INTO lesson_plans (concept, plan, run_id) VALUES (:c, :p, :r)"),
+                     [{"c": c, "p": plan, "r": run_id} for c, plan in plans.items()], batch_size)
+
+@traced("tidb.write_homework")
+def write_homework(engine: Engine, hw: Dict[str, str], batch_size: Optional[int] = None,
+                   run_id: Optional[str] = None):
+    with engine.begin() as conn:
+        _executemany(conn, text("INSERT INTO homework_personalized (student_name, homework, run_id) VALUES (:s, :h, :r)"),
+                     [{"s": s, "h": text_hw, "r": run_id} for s, text_hw in hw.items()], batch_size)
+
+@traced("tidb.write_reports")
+def write_reports(engine: Engine, reports: Dict[str, str], batch_size: Optional[int] = None,
+                  run_id: Optional[str] = None):
+    with engine.begin() as conn:
+        _executemany(conn, text("INSERT INTO student_reports (student_name, report, run_id) VALUES (:s, :r, :run)"),
+                     [{"s": s, "r": r, "run": run_id} for s, r in reports.items()], batch_size)
+
+def _latest_text(conn, table: str, key: str, value: str, keys: List[str], run_id: Optional[str] = None) -> Dict[str, str]:
+    # `value` per `key` among `keys` from that run (the (run_id, key) index), or, for rows written before
+    # run ids, the newest per key (the (key, id) index answers the MAX(id) subquery)
+    if not keys:
+        return {}
+    if run_id is not None:
+        stmt = text(f"SELECT {key}, {value} FROM {table} WHERE run_id = :r AND {key} IN :k ORDER BY id")
+        params = {"r": run_id, "k": list(keys)}
+    else:
+        stmt = text(f"""
+            SELECT t.{key}, t.{value} FROM {table} t
+            JOIN (SELECT MAX(id) AS id FROM {table} WHERE {key} IN :k GROUP BY {key}) latest ON t.id = latest.id
+            """)
+        params = {"k": list(keys)}
+    return {r[0]: r[1] for r in conn.execute(stmt.bindparams(bindparam("k", expanding=True)), params).fetchall()}
+
+@traced("tidb.load_latest_results")
+def load_latest_results(engine: Engine, student_names: List[str], concepts: List[str]) -> Dict[str, Any]:
+    """
+    The most recent persisted results for this class, shaped like the pipeline's output
+    (scores, pain_points, reports, groups, lesson_plans, homework); keys with nothing stored come back empty.
+    - Scores / pain points: latest comprehension row per (student, concept).
+    - The latest run is the newest run_id among those rows; groups, lesson plans, homework and reports come
+      from that run only, so a concept that is no longer weak has no plan.
+    - Rows from before run ids: latest plan per concept, latest homework / report per student.
+    """
+    comp = latest_comprehension(engine, student_names, concepts)
+    run_id = max((row["run_id"] for row in comp.values() if row.get("run_id")), default=None)
+    scores = ScoreMatrix(list(student_names), list(concepts))
+    pain_points: Dict[str, Dict[str, List[str]]] = {}
+    for (s, c), row in comp.items():
+        scores.set(s, c, row["score"])
+        pain_points.setdefault(s, {})[c] = row["pain_points"]
+    groups: Dict[int, List[str]] = {}
+    with engine.connect() as conn:
+        if student_names:
+            run_filter = "AND run_id = :r" if run_id is not None else ""
+            stmt = text(f"""SELECT group_id, student_name FROM study_groups WHERE student_name IN :s {run_filter}
+                            ORDER BY group_id, student_name""").bindparams(bindparam("s", expanding=True))
+            for gid, s in conn.execute(stmt, {"s": list(student_names), "r": run_id}).fetchall():
+                groups.setdefault(int(gid), []).append(s)
+        plans = _latest_text(conn, "lesson_plans", "concept", "plan", list(concepts), run_id)
+        homework = _latest_text(conn, "homework_personalized", "student_name", "homework", list(student_names), run_id)
+        reports = _latest_text(conn, "student_reports", "student_name", "report", list(student_names), run_id)
+    return {
+        "scores": scores if comp else {},
+        "pain_points": pain_points,
+        "reports": {s: reports[s] for s in student_names if s in reports},
+        "groups": groups,
+        "lesson_plans": {c: plans[c] for c in concepts if c in plans},
+        "homework": {s: homework[s] for s in student_names if s in homework},
+    }
+
+@traced("tidb.score_history")
+def score_history(engine: Engine, student_name: str, concepts: Optional[List[str]] = None,
+                  since: Optional[Any] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    One student's scores over time, oldest first: {concept: [{"score", "run_id", "at"}]}.
+    A range read of idx_comp_history (student_name, concept, created_at).
+    """
+    where, params = ["student_name = :s"], {"s": student_name}
+    if concepts:
+        where.append("concept IN :c")
+        params["c"] = list(concepts)
+    if since is not None:
+        where.append("created_at >= :since")
+        params["since"] = since
+    stmt = text(f"""SELECT concept, score, run_id, created_at FROM comprehension
+                    WHERE {' AND '.join(where)} ORDER BY concept, created_at, id""")
+    if concepts:
+        stmt = stmt.bindparams(bindparam("c", expanding=True))
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    with engine.connect() as conn:
+        for c, score, run_id, at in conn.execute(stmt, params).fetchall():
+            out.setdefault(c, []).append({"score": float(score), "run_id": run_id, "at": at})
+    return out
 
-def write_lesson_plans(engine: Engine, plans: Dict[str, str]):
+@traced("tidb.concept_trends")
+def concept_trends(engine: Engine, concepts: List[str], since: Optional[Any] = None,
+                   last_runs: Optional[int] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Class-level aggregates per run, oldest first:
+    {concept: [{"run_id", "at", "students", "mean", "min", "max", "weak_students"}]}.
+    Reads only the concept_run_stats rollup (one row per run and concept, idx_crs_concept_time),
+    so a year of nightly runs is a few hundred rows per concept whatever the class size.
+    last_runs keeps each concept's most recent n runs.
+    """
+    if not concepts:
+        return {}
+    where, params = ["concept IN :c"], {"c": list(concepts)}
+    if since is not None:
+        where.append("run_at >= :since")
+        params["since"] = since
+    inner = f"""SELECT run_id, concept, students, score_sum, min_score, max_score, weak_students, run_at,
+                       ROW_NUMBER() OVER (PARTITION BY concept ORDER BY run_at DESC) AS rn
+                FROM concept_run_stats WHERE {' AND '.join(where)}"""
+    limit = ""
+    if last_runs:
+        limit = "WHERE rn <= :n"
+        params["n"] = int(last_runs)
+    stmt = text(f"""SELECT run_id, concept, students, score_sum, min_score, max_score, weak_students, run_at
+                    FROM ({inner}) ranked {limit} ORDER BY concept, run_at""").bindparams(bindparam("c", expanding=True))
+    out: Dict[str, List[Dict[str, Any]]] = {c: [] for c in concepts}
+    with engine.connect() as conn:
+        for run_id, c, n, total, lo, hi, weak, at in conn.execute(stmt, params).fetchall():
+            out[c].append({"run_id": run_id, "at": at, "students": int(n), "mean": round(float(total) / max(1, n), 2),
+                           "min": float(lo), "max": float(hi), "weak_students": int(weak or 0)})
+    return out
+
+def _ident(name: str) -> str:
+    # vector table names come from the UI; only plain identifiers are allowed into SQL
+    if not re.fullmatch(r"[A-Za-z0-9_]{1,64}", name or ""):
+        raise ValueError(f"Invalid table name: {name!r}")
+    return f"`{name}`"
+
+def class_table(base: str, class_id: str) -> str:
+    """
+    Per-class vector table name (<base>_<class id>): giving each class its own table partitions the chunks
+    by class, so a class's searches never touch another class's rows.
+    """
+    slug = re.sub(r"[^A-Za-z0-9_]", "_", class_id)
+    name = f"{base}_{slug}"
+    if len(name) > 64:
+        name = f"{base[:47]}_{hashlib.sha256(class_id.encode('utf-8')).hexdigest()[:16]}"
+    return _ident(name).strip("`")
+
+def _engine_key(engine: Engine, table_name: str) -> tuple:
+    return (str(getattr(engine, "url", id(engine))), table_name)
+
+def vector_table_features(engine: Engine, table_name: str) -> Dict[str, Any]:
+    """
+    What provision_vector_table() set up for this table in this process ({} if it has not run).
+    """
+    return _vector_tables.get(_engine_key(engine, table_name), {})
+
+@traced("tidb.provision_vector_table")
+def provision_vector_table(engine: Engine, table_name: str, vector_index: bool = VECTOR_INDEX_ENABLED,
+                           tiflash_replicas: int = VECTOR_TIFLASH_REPLICAS) -> Dict[str, Any]:
+    """
+    Indexes a table created by TiDBVectorStore (idempotent; runs once per table per process).
+    - student_name: a virtual column generated from meta.student_name, with a B-tree index, so a per-student
+      search reads only that student's rows instead of every row of the table.
+    - idx_vec_embedding: an HNSW index on VEC_COSINE_DISTANCE(embedding) for unfiltered top-k search
+      (lesson retrieval). TiDB builds vector indexes on TiFlash, so a replica is requested first; clusters
+      without TiFlash keep exact search and report vector_index=False.
+    """
+    key = _engine_key(engine, table_name)
+    with _schema_lock:
+        if key in _vector_tables:
+            return _vector_tables[key]
+        t = _ident(table_name)
+        features: Dict[str, Any] = {"student_column": True, "vector_index": False}
+        with engine.begin() as conn:
+            if not _has_column(conn, table_name, "student_name"):
+                conn.execute(text(f"""ALTER TABLE {t} ADD COLUMN student_name VARCHAR(255)
+                                      AS (JSON_UNQUOTE(JSON_EXTRACT(meta, '$.student_name'))) VIRTUAL"""))
+            if not _has_index(conn, table_name, "idx_vec_student"):
+                conn.execute(text(f"ALTER TABLE {t} ADD INDEX idx_vec_student (student_name)"))
+        if vector_index:
+            try:
+                with engine.begin() as conn:
+                    if not _has_index(conn, table_name, "idx_vec_embedding"):
+                        if tiflash_replicas:
+                            conn.execute(text(f"ALTER TABLE {t} SET TIFLASH REPLICA {int(tiflash_replicas)}"))
+                        conn.execute(text(f"""ALTER TABLE {t} ADD VECTOR INDEX idx_vec_embedding
+                                              ((VEC_COSINE_DISTANCE(embedding))) USING HNSW"""))
+                features["vector_index"] = True
+            except Exception as e:
+                if "Duplicate key name" in str(e):  # some versions leave vector indexes out of information_schema
+                    features["vector_index"] = True
+                else:
+                    features["vector_index_error"] = f"{type(e).__name__}: {e}"
+        _vector_tables[key] = features
+        return features
+
+@traced("tidb.ingested_file_hashes")
+def ingested_file_hashes(engine: Engine, table_name: str, student_names: List[str]) -> Dict[tuple, str]:
+    """
+    {(student_name, source_file): file_hash} for files already fully ingested into table_name.
+    """
+    if not student_names:
+        return {}
+    stmt = text("""SELECT student_name, source_file, file_hash FROM ingest_manifest
+                   WHERE table_name = :t AND student_name IN :s""").bindparams(bindparam("s", expanding=True))
+    with engine.connect() as conn:
+        rows = conn.execute(stmt, {"t": table_name, "s": list(student_names)}).fetchall()
+    return {(r[0], r[1]): r[2] for r in rows}
+
+@traced("tidb.mark_file_ingested")
+def mark_file_ingested(engine: Engine, table_name: str, student_name: str, source_file: str, file_hash: str, chunk_count: int):
     with engine.begin() as conn:
-        for c, plan in plans.items():
-            conn.execute(text("INSERT INTO lesson_plans (concept, plan) VALUES (:c, :p)"),
-                         {"c": c, "p": plan})
+        conn.execute(
+            text("""INSERT INTO ingest_manifest (table_name, student_name, source_file, file_hash, chunk_count)
+                    VALUES (:t, :s, :f, :h, :n)
+                    ON DUPLICATE KEY UPDATE file_hash = VALUES(file_hash), chunk_count = VALUES(chunk_count)"""),
+            {"t": table_name, "s": student_name, "f": source_file, "h": file_hash, "n": chunk_count}
+        )
 
-def write_homework(engine: Engine, hw: Dict[str, str]):
+@traced("tidb.delete_stale_file_chunks")
+def delete_stale_file_chunks(engine: Engine, table_name: str, student_name: str, source_file: str, keep_hash: str) -> int:
+    """
+    Remove chunks of an earlier version of source_file (any file_hash other than keep_hash) from a vector table.
+    """
+    student = "student_name" if vector_table_features(engine, table_name).get("student_column") \
+        else "JSON_UNQUOTE(JSON_EXTRACT(meta, '$.student_name'))"
     with engine.begin() as conn:
-        for s, text_hw in hw.items():
-            conn.execute(text("INSERT INTO homework_personalized (student_name, homework) VALUES (:s, :h)"),
-                         {"s": s, "h": text_hw})
+        res = conn.execute(
+            text(f"""DELETE FROM {_ident(table_name)}
+                     WHERE {student} = :s
+                       AND JSON_UNQUOTE(JSON_EXTRACT(meta, '$.source_file')) = :f
+                       AND COALESCE(JSON_UNQUOTE(JSON_EXTRACT(meta, '$.file_hash')), '') <> :h"""),
+            {"s": student_name, "f": source_file, "h": keep_hash}
+        )
+        return res.rowcount
+
+@traced("tidb.existing_vector_ids")
+def existing_vector_ids(engine: Engine, table_name: str, ids: List[str]) -> set:
+    if not ids:
+        return set()
+    stmt = text(f"SELECT id FROM {_ident(table_name)} WHERE id IN :ids").bindparams(bindparam("ids", expanding=True))
+    with engine.connect() as conn:
+        return {r[0] for r in conn.execute(stmt, {"ids": list(ids)})}
@@ -1,68 +1,425 @@
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
 from langchain.docstore.document import Document
+from langchain.embeddings import CacheBackedEmbeddings
 from dotenv import load_dotenv
 from langchain_community.vectorstores import TiDBVectorStore
 import os
-from typing import TypedDict, List, Dict, Any, Optional
+from typing import TypedDict, List, Dict, Any, Optional, Iterator, Tuple
 from .tidb import *
+from .tidb import _ident
+from .cache import get_llm_cache, llm_cache_stats, get_embedding_store
+from .instrumentation import traced, llm_callbacks
+from .rate_limit import get_rate_limiter
+from . import instrumentation
+from concurrent.futures import Future, ProcessPoolExecutor
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from collections import deque
+from pypdf import PdfReader
+import contextvars
+import multiprocessing
+import hashlib
+import io
+import json
+import queue
+import threading
+import time
 import uuid
 
 load_dotenv()
 os.environ["OPENAI_API_KEY"] =os.getenv('OPENAI_API_KEY')
 
+_registry_lock = threading.Lock()
+_embeddings = None
+_vectorstores: Dict[tuple, Future] = {}  # (connection string, table) -> Future[TiDBVectorStore]
+
 def get_embeddings():
-    return OpenAIEmbeddings()
+    """
+    OpenAI embeddings behind a local cache keyed on sha256(chunk text), namespaced by model.
+    Built once per process.
+    """
+    global _embeddings
+    with _registry_lock:
+        if _embeddings is None:
+            base = OpenAIEmbeddings()
+            _embeddings = CacheBackedEmbeddings.from_bytes_store(
+                base, get_embedding_store(), namespace=f"{base.model}:", key_encoder="sha256", query_embedding_cache=True
+            )
+        return _embeddings
 
-def get_llm():
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", str(os.cpu_count() or 1)))
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "64"))  # chunks per embedding request / insert
+INGEST_QUEUE_DEPTH = int(os.getenv("INGEST_QUEUE_DEPTH", "4"))  # batches buffered between stages
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "8"))
+VECTOR_TABLE_PROVISION = os.getenv("VECTOR_TABLE_PROVISION", "1") != "0"  # see tidb.provision_vector_table
+
+def get_llm(use_cache: bool = LLM_CACHE_ENABLED):
+    """
+    use_cache=False bypasses the on-disk response cache (tooling/cache.py) for this client.
+    """
     model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-    return ChatOpenAI(model=model, temperature=0.2)
+    return ChatOpenAI(model=model, temperature=0.2, cache=get_llm_cache() if use_cache else False,
+                      callbacks=llm_callbacks(), rate_limiter=get_rate_limiter(), stream_usage=True)
 
 def get_vectorstore(table_name: str) -> TiDBVectorStore:
     """
     Returns (or creates) a TiDB vector table through LangChain.
     The table schema includes id, embedding (VECTOR), document, meta (JSON), timestamps.  # docs-backed
+    Stores are reused per (connection string, table) for the life of the process; each store's client has its
+    own instrumented connection pool with the settings of tidb.engine_args().
+    New stores get the indexed student_name column and the HNSW index (provision_vector_table).
+    - The first caller for a table builds and provisions it outside the registry lock; concurrent callers
+      for the same table wait on its Future, other tables are not held up. A failed build is retried next call.
     """
-    vs = TiDBVectorStore(
-        connection_string=tidb_connection_string(),
-        embedding_function=get_embeddings(),
-        table_name=table_name,
-        distance_strategy="cosine",
-    )
+    url = tidb_connection_string()
+    key = (url, table_name)
+    with _registry_lock:
+        pending = _vectorstores.get(key)
+        building = pending is None
+        if building:
+            pending = _vectorstores[key] = Future()
+    if not building:
+        return pending.result()
+    try:
+        engine = get_engine(url)
+        # the client builds its own Engine: same URL and pool settings, but a pool of its own (engines sharing
+        # a Pool break on dispose(), which tidb-vector calls on the throwaway engines of its table check)
+        vs = TiDBVectorStore(
+            connection_string=url,
+            embedding_function=get_embeddings(),
+            table_name=table_name,
+            distance_strategy="cosine",
+            engine_args=engine_args(),
+        )
+        instrument_engine(vs.tidb_vector_client._bind)  # tidb-vector keeps the client's Engine in _bind (pinned)
+        if VECTOR_TABLE_PROVISION:
+            provision_vector_table(engine, table_name)
+    except BaseException as e:
+        with _registry_lock:
+            del _vectorstores[key]
+        pending.set_exception(e)
+        raise
+    pending.set_result(vs)
     return vs
 
-def load_pdfs_to_docs(file, student_name: str) -> List[Document]:
-    # Save to tmp and load
-    tmp_path = f"/tmp/{uuid.uuid4()}.pdf"
-    with open(tmp_path, "wb") as f:
-        f.write(file.getbuffer())
-    loader = PyPDFLoader(tmp_path)
-    raw_docs = loader.load()
-    # Attach metadata for student
-    for d in raw_docs:
-        d.metadata = d.metadata or {}
-        d.metadata.update({
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def split_pdf_bytes(name: str, data: bytes, student_name: str) -> List[Document]:
+    """
+    Parse and chunk one PDF straight from memory (no temp file). Top-level so process pools can run it.
+    """
+    file_hash = _sha256(data)
+    reader = PdfReader(io.BytesIO(data))
+    raw_docs = [
+        Document(page_content=page.extract_text() or "", metadata={
+            "source": name,
+            "page": i,
+            "total_pages": len(reader.pages),
             "student_name": student_name,
-            "source_file": file.name
+            "source_file": name,
+            "file_hash": file_hash,
         })
+        for i, page in enumerate(reader.pages)
+    ]
     # Chunk
     splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000, chunk_overlap=150, separators=["\n\n", "\n", " ", ""]
+        chunk_size=1000, chunk_overlap=150, separators=["\n\n", "\n", " ", ""], add_start_index=True
     )
     docs = splitter.split_documents(raw_docs)
+    # Deterministic ids: re-ingesting the same file version maps onto the same rows
+    for i, d in enumerate(docs):
+        d.metadata["chunk_hash"] = _sha256(d.page_content.encode("utf-8"))
+        d.metadata["chunk_index"] = i  # neighbours overlap by chunk_overlap; context packing stitches them back
+        d.id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{student_name}|{name}|{file_hash}|{i}"))
     return docs
 
-def ingest_documents(docs: List[Document], vs: TiDBVectorStore):
-    vs.add_documents(docs)
+def load_pdfs_to_docs(file, student_name: str) -> List[Document]:
+    return split_pdf_bytes(file.name, bytes(file.getbuffer()), student_name)
+
+def iter_pdf_docs(files, student_name: str, max_workers: int = PDF_PARSE_WORKERS) -> Iterator[Tuple[str, List[Document], Optional[Exception]]]:
+    """
+    Yields (file name, chunks, error) per uploaded file, in upload order.
+    - Parsing fans out over a process pool with at most 2*max_workers files in flight.
+    - A file that fails to parse yields ([], error) instead of aborting the rest.
+    """
+    jobs = iter([(f.name, f) for f in files])
+    max_workers = min(max_workers, len(files))
+    if max_workers <= 1:
+        for name, f in jobs:
+            try:
+                yield name, split_pdf_bytes(name, bytes(f.getbuffer()), student_name), None
+            except Exception as e:
+                yield name, [], e
+        return
+    # spawn: forking a threaded server (Streamlit) can deadlock the children
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = deque()
+        def submit_next():
+            job = next(jobs, None)
+            if job is not None:
+                name, f = job
+                pending.append((name, pool.submit(split_pdf_bytes, name, bytes(f.getbuffer()), student_name)))
+        for _ in range(2 * max_workers):
+            submit_next()
+        while pending:
+            name, fut = pending.popleft()
+            submit_next()
+            try:
+                yield name, fut.result(), None
+            except Exception as e:
+                yield name, [], e
+
+def _table_name(vs: TiDBVectorStore) -> str:
+    return vs.tidb_vector_client._table_name
+
+def _pending_file_docs(engine, table: str, done: Dict[tuple, str], file_docs: List[Document]) -> Optional[List[Document]]:
+    """
+    None if this file version is already fully ingested; otherwise drops rows of older versions
+    and returns the chunks not yet in the table.
+    """
+    meta = file_docs[0].metadata
+    student, source, file_hash = meta["student_name"], meta["source_file"], meta["file_hash"]
+    if done.get((student, source)) == file_hash:
+        return None
+    delete_stale_file_chunks(engine, table, student, source, file_hash)
+    present = existing_vector_ids(engine, table, [d.id for d in file_docs if d.id])
+    return [d for d in file_docs if d.id not in present]
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
+def _drain(q: queue.Queue, stop: threading.Event):
+    while True:
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        if item is None:
+            return
+        yield item
+
+@traced("vector.stream_ingest")
+def stream_ingest(files, student_name: str, vs: TiDBVectorStore, batch_size: int = INGEST_EMBED_BATCH,
+                  queue_depth: int = INGEST_QUEUE_DEPTH, on_progress=None) -> Dict[str, Any]:
+    """
+    Incremental PDF ingestion for uploads (Homework / Lesson tabs); returns ingestion stats.
+    - Three overlapping stages joined by bounded queues (backpressure): parse (process pool) -> embed -> insert.
+      At most ~queue_depth batches per queue are held in memory, whatever the upload size.
+    - Every inserted batch is committed on its own, and a file is recorded in ingest_manifest once its
+      last batch lands; a rerun after a failure skips finished files and already-inserted chunk ids.
+    - A changed file first drops the rows of its previous version (_pending_file_docs).
+    - on_progress(stats) is called from the calling thread after every batch/file.
+    """
+    engine = get_engine()
+    table = _table_name(vs)
+    client = vs.tidb_vector_client
+    embeddings = vs.embeddings
+    stats: Dict[str, Any] = {"files": len(files), "files_done": 0, "files_skipped": 0,
+                             "chunks_inserted": 0, "chunks_skipped": 0, "chunks_per_s": 0.0, "errors": []}
+    done = ingested_file_hashes(engine, table, [student_name])
+    to_embed: queue.Queue = queue.Queue(queue_depth)
+    to_insert: queue.Queue = queue.Queue(queue_depth)
+    stop = threading.Event()
+    failures: List[BaseException] = []
+
+    def parse_stage():
+        try:
+            for name, docs, err in iter_pdf_docs(files, student_name):
+                if err is not None:
+                    item = ("error", name, err)
+                elif not docs:
+                    item = ("file", name, None, 0, 0)
+                else:
+                    fresh = _pending_file_docs(engine, table, done, docs)
+                    if fresh is None:
+                        item = ("skip", name, len(docs))
+                    else:
+                        for i in range(0, len(fresh), batch_size):
+                            if not _put(to_embed, ("batch", fresh[i:i + batch_size]), stop):
+                                return
+                        item = ("file", name, docs[0].metadata["file_hash"], len(docs), len(docs) - len(fresh))
+                if not _put(to_embed, item, stop):
+                    return
+        except BaseException as e:
+            failures.append(e)
+            stop.set()
+        finally:
+            _put(to_embed, None, stop)
+
+    def embed_stage():
+        try:
+            for item in _drain(to_embed, stop):
+                if item[0] == "batch":
+                    with instrumentation.span("embeddings.embed_documents", "client", texts=len(item[1])):
+                        vectors = embeddings.embed_documents([d.page_content for d in item[1]])
+                    item = ("batch", item[1], vectors)
+                if not _put(to_insert, item, stop):
+                    return
+        except BaseException as e:
+            failures.append(e)
+            stop.set()
+        finally:
+            _put(to_insert, None, stop)
+
+    # stage threads run in a copy of the caller's context so their spans land in the current trace
+    workers = [threading.Thread(target=contextvars.copy_context().run, args=(stage,), daemon=True)
+               for stage in (parse_stage, embed_stage)]
+    for w in workers:
+        w.start()
+    started = time.perf_counter()
+    try:
+        for item in _drain(to_insert, stop):
+            kind = item[0]
+            if kind == "batch":
+                docs, vectors = item[1], item[2]
+                with instrumentation.span("vector.add_documents", "client", chunks=len(docs)):
+                    client.insert(texts=[d.page_content for d in docs], embeddings=vectors,
+                                  metadatas=[d.metadata for d in docs], ids=[d.id for d in docs])
+                stats["chunks_inserted"] += len(docs)
+            elif kind == "file":
+                _, name, file_hash, total, existing = item
+                if file_hash:
+                    mark_file_ingested(engine, table, student_name, name, file_hash, total)
+                stats["files_done"] += 1
+                stats["chunks_skipped"] += existing
+            elif kind == "skip":
+                stats["files_skipped"] += 1
+                stats["chunks_skipped"] += item[2]
+            elif kind == "error":
+                stats["errors"].append((item[1], str(item[2])))
+            stats["chunks_per_s"] = stats["chunks_inserted"] / max(time.perf_counter() - started, 1e-9)
+            if on_progress:
+                on_progress(stats)
+    finally:
+        stop.set()
+        for w in workers:
+            w.join()
+    if failures:
+        raise failures[0]
+    return stats
+
+def _student_indexed(vs: TiDBVectorStore) -> bool:
+    # the table has the generated, indexed student_name column (provision_vector_table)
+    client = getattr(vs, "tidb_vector_client", None)
+    return client is not None and bool(vector_table_features(get_engine(), client._table_name).get("student_column"))
+
+def _indexed_student_search(vs: TiDBVectorStore, student_name: str, concept: str, k: int) -> List[Document]:
+    stmt = text(f"""
+        SELECT id, document, meta, VEC_COSINE_DISTANCE(embedding, :q) AS distance
+        FROM {_ident(_table_name(vs))}
+        WHERE student_name = :s
+        ORDER BY distance
+        LIMIT :k""")
+    with get_engine().connect() as conn:
+        rows = conn.execute(stmt, {"q": json.dumps(embed_queries(vs, [concept])[concept]), "s": student_name, "k": k})
+        return [_row_doc(r) for r in rows]
+
+def _row_doc(row) -> Document:
+    meta = json.loads(row.meta) if isinstance(row.meta, str) else dict(row.meta or {})
+    meta["distance"] = float(row.distance)
+    return Document(id=row.id, page_content=row.document, metadata=meta)
+
+@traced("vector.similarity_search", "client")
 def retrieve_student_context(vs: TiDBVectorStore, student_name: str, concept: str, k: int = 6) -> List[Document]:
     """
-    Try metadata filter (meta JSON) if supported; otherwise post-filter.
+    On provisioned tables: the student's rows come from the student_name index and are ranked by exact
+    cosine distance, so the cost follows that student's chunk count, not the table size.
+    Otherwise try metadata filter (meta JSON) if supported; otherwise post-filter.
     """
+    if _student_indexed(vs):
+        return _indexed_student_search(vs, student_name, concept, k)
     try:
         docs = vs.similarity_search(f"{concept}", k=16, filter={"student_name": student_name})
     except Exception: # Fallback just in case
         docs = vs.similarity_search(f"{concept}", k=32)
         docs = [d for d in docs if (d.metadata or {}).get("student_name") == student_name]
     return docs[:k]
+
+_query_vectors: Dict[tuple, List[float]] = {}
+
+@traced("embeddings.embed_queries", "client")
+def embed_queries(vs: TiDBVectorStore, queries: List[str]) -> Dict[str, List[float]]:
+    """
+    Query vectors for every string, memoized per process; all misses go out in one embedding request.
+    """
+    emb = vs.embeddings
+    model = getattr(getattr(emb, "underlying_embeddings", emb), "model", "")
+    missing = [q for q in dict.fromkeys(queries) if (model, q) not in _query_vectors]
+    if missing:
+        for q, vec in zip(missing, emb.embed_documents(missing)):
+            _query_vectors[(model, q)] = list(vec)
+    return {q: _query_vectors[(model, q)] for q in queries}
+
+@traced("vector.retrieve_students_context_batch")
+def retrieve_students_context_batch(vs: TiDBVectorStore, students: List[str], concepts: List[str], k: int = 6) -> Dict[tuple, List[Document]]:
+    """
+    Top-k chunks for every (student, concept) pair: one embedding batch for the concepts, then one
+    windowed SQL query per concept covering all students. Falls back to per-pair retrieval for
+    stores without SQL access.
+    On provisioned tables the students' rows are found through the student_name index instead of
+    evaluating meta JSON on every row.
+    """
+    out: Dict[tuple, List[Document]] = {(s, c): [] for s in students for c in concepts}
+    if not students or not concepts:
+        return out
+    if not hasattr(vs, "tidb_vector_client"):
+        for s in students:
+            for c in concepts:
+                out[(s, c)] = retrieve_student_context(vs, s, c, k=k)
+        return out
+    vectors = embed_queries(vs, concepts)
+    sname = "student_name" if _student_indexed(vs) else "JSON_UNQUOTE(JSON_EXTRACT(meta, '$.student_name'))"
+    stmt = text(f"""
+        SELECT id, document, meta, sname, distance FROM (
+            SELECT id, document, meta, sname, distance,
+                   ROW_NUMBER() OVER (PARTITION BY sname ORDER BY distance) AS rn
+            FROM (
+                SELECT id, document, meta,
+                       {sname} AS sname,
+                       VEC_COSINE_DISTANCE(embedding, :q) AS distance
+                FROM {_ident(_table_name(vs))}
+                WHERE {sname} IN :students
+            ) scored
+        ) ranked
+        WHERE rn <= :k
+        ORDER BY sname, distance""").bindparams(bindparam("students", expanding=True))
+    with get_engine().connect() as conn:
+        for c in dict.fromkeys(concepts):
+            rows = conn.execute(stmt, {"q": json.dumps(vectors[c]), "students": list(students), "k": k})
+            for row in rows:
+                out[(row.sname, c)].append(_row_doc(row))
+    return out
+
+@traced("vector.prefetch_lesson_context")
+def prefetch_lesson_context(vs: TiDBVectorStore, concepts: List[str], k: int, max_workers: int = RETRIEVAL_WORKERS) -> Dict[str, List[Document]]:
+    """
+    Top-k lesson chunks for each distinct concept, searched in parallel (queries embedded in one batch).
+    Callers needing fewer chunks slice the lists. These unfiltered ORDER BY distance LIMIT k searches are
+    the ones the HNSW index serves.
+    """
+    concepts = list(dict.fromkeys(concepts))
+    if not concepts:
+        return {}
+    client = getattr(vs, "tidb_vector_client", None)
+    if client is not None:
+        vectors = embed_queries(vs, concepts)
+        def search(c: str) -> List[Document]:
+            with instrumentation.span("vector.similarity_search", "client", k=k):
+                return [Document(id=r.id, page_content=r.document, metadata={**(r.metadata or {}), "distance": r.distance})
+                        for r in client.query(query_vector=vectors[c], k=k)]
+    else:
+        def search(c: str) -> List[Document]:
+            with instrumentation.span("vector.similarity_search", "client", k=k):
+                return vs.similarity_search(c, k=k)
+    with ContextThreadPoolExecutor(max_workers=max(1, min(max_workers, len(concepts)))) as pool:
+        return dict(zip(concepts, pool.map(search, concepts)))